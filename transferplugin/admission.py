@@ -0,0 +1,334 @@
+# Transfer VM - VPX for exposing VDIs on XenServer
+# Copyright (C) Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Admission control for the Transfer VMs that the expose calls on this host
+boot.
+
+Left alone, a burst of expose calls clones and boots a Transfer VM for each
+at once, and xapi and the SRs slow down until boots start to time out.
+Instead, each expose takes a slot from here before it clones its Transfer
+VM, and holds it until the Transfer VM is ready.  A call waits for a slot
+while max_boots Transfer VMs are booting, or while max_running Transfer VMs
+that this host admitted are running, for no longer than timeout seconds.
+Waiting calls are admitted in the order in which they asked.
+
+The limits come from the host's other_config, so that they may be set with
+xe host-param-set, and a limit of 0 means no limit.  None is set by default,
+so expose calls start their Transfer VMs at once, as they always have, until
+an operator sets one:
+
+    transfervm_max_boots            default DEFAULT_MAX_BOOTS
+    transfervm_max_running          default DEFAULT_MAX_RUNNING
+    transfervm_admission_timeout    default DEFAULT_TIMEOUT_SECONDS
+
+Each plugin call is a process of its own, so the queue lives in a file in
+dom0, holding the call's ticket, its process, whether it is waiting or
+booting, and the VDIs it is exposing, in the order the calls asked.  Entries
+whose process has gone are dropped.
+"""
+
+import fcntl
+import os
+import threading
+import time
+
+from pluginlib import *
+
+
+QUEUE_DIR = '/var/run/transfervm/'
+QUEUE_PATH = QUEUE_DIR + 'admission'
+QUEUE_LOCK_PATH = QUEUE_DIR + 'admission.lock'
+
+MAX_BOOTS_KEY = 'transfervm_max_boots'
+MAX_RUNNING_KEY = 'transfervm_max_running'
+TIMEOUT_KEY = 'transfervm_admission_timeout'
+
+DEFAULT_MAX_BOOTS = 0
+DEFAULT_MAX_RUNNING = 0
+DEFAULT_TIMEOUT_SECONDS = 600
+
+# The key in a Transfer VM's other_config that holds the uuid of the host
+# that admitted it.
+ADMITTED_BY_KEY = 'transfervm_admitted_by'
+# The key that the transfer plugin sets on a Transfer VM once it has been
+# exposed (UTILITY_VM_EXPOSEDONE).
+EXPOSEDONE_KEY = 'transfervm_exposedone'
+
+# How often, in seconds, a waiting call checks the queue.
+POLL_INTERVAL = 1.0
+
+WAITING = 'waiting'
+BOOTING = 'booting'
+
+
+class AdmissionTimeout(PluginError):
+    """An expose waited too long for this host to admit it."""
+    def __init__(self, *args):
+        PluginError.__init__(self, *args)
+
+
+##### Code
+
+class Limits(object):
+    def __init__(self, max_boots, max_running, timeout):
+        self.max_boots = max_boots
+        self.max_running = max_running
+        self.timeout = timeout
+
+
+class Ticket(object):
+    """A call's place in the queue, which must be handed to release."""
+    def __init__(self, ticket_id, host_uuid):
+        self.ticket_id = ticket_id
+        self.host_uuid = host_uuid
+
+
+# How many tickets this process has taken, to tell them apart, and the lock
+# that guards it from the threads of the process.
+tickets_taken = 0
+tickets_lock = threading.Lock()
+
+
+def admit(session, vdi_uuids):
+    """
+    Waits until this host admits an expose of the given VDIs, and returns
+    its Ticket, or None if there are no limits.  The Transfer VM must be
+    tagged with tag_vm, and the Ticket handed to release once it is ready
+    or has failed.  Raises AdmissionTimeout if the call is not admitted in
+    time.
+    """
+    host_ref = get_this_host(session)
+    limits = read_limits(session.xenapi.host.get_other_config(host_ref))
+    if limits.max_boots == 0 and limits.max_running == 0:
+        return None
+
+    ticket = Ticket(new_ticket_id(), session.xenapi.host.get_uuid(host_ref))
+    entries = lock_queue()
+    try:
+        entries.append({'ticket': ticket.ticket_id,
+                        'pid': os.getpid(),
+                        'state': WAITING,
+                        'vdi_uuids': vdi_uuids})
+    finally:
+        unlock_queue(entries)
+
+    admitted = False
+    try:
+        deadline = monotonic_time() + limits.timeout
+        position = None
+        running = 0
+        while True:
+            # Only the call at the head of the queue can be admitted, so only
+            # it needs to know how many Transfer VMs are running.
+            if limits.max_running and position in [None, 1]:
+                running = count_running(session, ticket.host_uuid)
+            new_position = try_admit(ticket, limits, running)
+            if new_position == 0:
+                log.debug('Admitted expose of %s.', ','.join(vdi_uuids))
+                admitted = True
+                return ticket
+            if new_position != position:
+                log.debug('Expose of %s is waiting at position %d.',
+                          ','.join(vdi_uuids), new_position)
+                position = new_position
+            if limits.timeout and monotonic_time() > deadline:
+                raise AdmissionTimeout(
+                    'Expose of %s was not admitted within %d seconds; it '
+                    'was at position %d of the queue.' %
+                    (','.join(vdi_uuids), limits.timeout, position))
+            time.sleep(POLL_INTERVAL)
+    finally:
+        if not admitted:
+            release(ticket)
+
+
+def try_admit(ticket, limits, running):
+    """Admits the given ticket if it is at the head of the queue and there
+    is room, returning 0, or else returns its position among the waiting
+    calls, counting from 1."""
+    entries = lock_queue()
+    try:
+        waiting = [e for e in entries if e['state'] == WAITING]
+        booting = len(entries) - len(waiting)
+        position = 1
+        for entry in waiting:
+            if entry['ticket'] == ticket.ticket_id:
+                break
+            position += 1
+        if (position == 1 and
+                (not limits.max_boots or booting < limits.max_boots) and
+                (not limits.max_running or
+                 running + booting < limits.max_running)):
+            waiting[0]['state'] = BOOTING
+            return 0
+        return position
+    finally:
+        unlock_queue(entries)
+
+
+def tag_vm(session, ticket, vm):
+    """Marks the given Transfer VM as admitted by this host, for
+    count_running."""
+    if ticket is not None:
+        session.xenapi.VM.add_to_other_config(vm, ADMITTED_BY_KEY,
+                                              ticket.host_uuid)
+
+
+def release(ticket):
+    """Nothrow guarantee.  Gives up the given Ticket from admit, which may be
+    None."""
+    if ticket is None:
+        return
+    try:
+        entries = lock_queue()
+        try:
+            entries[:] = [e for e in entries
+                          if e['ticket'] != ticket.ticket_id]
+        finally:
+            unlock_queue(entries)
+    except Exception, exn:
+        log.warn('Ignoring exception when releasing admission ticket: %s',
+                 exn)
+
+
+def queue_status(vdi_uuid):
+    """
+    Returns ('queued', position) if an expose of the given VDI, or of a
+    comma-separated list of VDIs including it, is waiting to be admitted,
+    ('starting', None) if it has been admitted but is not ready yet, or else
+    None.
+    """
+    vdi_uuids = vdi_uuid.split(',')
+    entries = lock_queue()
+    try:
+        position = 0
+        for entry in entries:
+            if entry['state'] == WAITING:
+                position += 1
+            for u in vdi_uuids:
+                if u in entry['vdi_uuids']:
+                    if entry['state'] == WAITING:
+                        return ('queued', position)
+                    return ('starting', None)
+    finally:
+        unlock_queue(entries)
+    return None
+
+
+def read_limits(other_config):
+    def read(key, default):
+        value = other_config.get(key)
+        if value is None:
+            return default
+        try:
+            result = int(value)
+            if result < 0:
+                raise ValueError(value)
+            return result
+        except ValueError:
+            log.warn('Ignoring invalid %s %r in host other_config; using %d.',
+                     key, value, default)
+            return default
+    return Limits(read(MAX_BOOTS_KEY, DEFAULT_MAX_BOOTS),
+                  read(MAX_RUNNING_KEY, DEFAULT_MAX_RUNNING),
+                  read(TIMEOUT_KEY, DEFAULT_TIMEOUT_SECONDS))
+
+
+def count_running(session, host_uuid):
+    """Returns how many of the Transfer VMs that this host admitted are
+    running and have finished being exposed.  Those still being exposed are
+    counted by the queue."""
+    expr = 'field "power_state" = "Running"'
+    result = 0
+    for vmrec in session.xenapi.VM.get_all_records_where(expr).itervalues():
+        other_config = vmrec['other_config']
+        if (other_config.get(ADMITTED_BY_KEY) == host_uuid and
+                EXPOSEDONE_KEY in other_config):
+            result += 1
+    return result
+
+
+def new_ticket_id():
+    global tickets_taken
+    tickets_lock.acquire()
+    try:
+        tickets_taken += 1
+        return '%d.%d' % (os.getpid(), tickets_taken)
+    finally:
+        tickets_lock.release()
+
+
+class QueueEntries(list):
+    """The queue's entries, in order, along with the lock file that protects
+    them."""
+    pass
+
+
+def lock_queue():
+    """Takes the queue lock, and returns the entries, without those whose
+    process has gone, which must be passed to unlock_queue to write them
+    back and release the lock."""
+    if not os.path.exists(QUEUE_DIR):
+        try:
+            os.makedirs(QUEUE_DIR)
+        except OSError:
+            # Someone else created it first.
+            pass
+    lock_file = open(QUEUE_LOCK_PATH, 'w')
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    entries = QueueEntries()
+    entries.lock_file = lock_file
+    try:
+        f = open(QUEUE_PATH, 'r')
+        try:
+            for line in f:
+                ticket_id, pid, state, vdi_uuids = line.split()
+                if is_alive(int(pid)):
+                    entries.append({'ticket': ticket_id,
+                                    'pid': int(pid),
+                                    'state': state,
+                                    'vdi_uuids': vdi_uuids.split(',')})
+        finally:
+            f.close()
+    except IOError:
+        # No queue yet.
+        pass
+    except ValueError, exn:
+        log.warn('Ignoring corrupt admission queue: %s', exn)
+        del entries[:]
+    return entries
+
+
+def unlock_queue(entries):
+    lock_file = entries.lock_file
+    try:
+        tmp_path = QUEUE_PATH + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'w')
+        try:
+            for entry in entries:
+                f.write('%s %d %s %s\n' %
+                        (entry['ticket'], entry['pid'], entry['state'],
+                         ','.join(entry['vdi_uuids'])))
+        finally:
+            f.close()
+        os.rename(tmp_path, QUEUE_PATH)
+    finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
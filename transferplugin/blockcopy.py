@@ -0,0 +1,247 @@
+# Transfer VM - VPX for exposing VDIs on XenServer
+# Copyright (C) Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import mmap
+import os
+import Queue
+import sys
+import threading
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from pluginlib import *
+
+
+# The size of each read and write.  Buffers are page-aligned, and this is a
+# multiple of any block size that O_DIRECT could require.
+CHUNK_SIZE = 4 * 1024 * 1024
+# How many chunks may be read ahead of the writer.
+READ_AHEAD = 4
+# Seconds between progress messages.
+PROGRESS_INTERVAL = 10
+
+MiB = 1024 * 1024
+
+ZEROS = '\0' * CHUNK_SIZE
+
+
+class VerifyFailed(PluginError):
+    """The destination did not match the source after copying."""
+    def __init__(self, *args):
+        PluginError.__init__(self, *args)
+
+
+##### Code
+
+def copy_device(src_path, dest_path, direct=False, sparse=False,
+                verify=False):
+    """
+    Copy the whole of the block device at src_path onto dest_path.
+
+    A reader thread fills CHUNK_SIZE buffers while this thread writes them
+    out.  If direct is set, both devices are opened with O_DIRECT.  If
+    sparse is set, the destination must already read as zeros (a new VDI on
+    a thin-provisioned SR, say): chunks of zeros are then skipped rather
+    than written.  If verify is set, an MD5 of each chunk is taken as it is
+    read, and the destination is read back afterwards and checked against
+    them.
+
+    Any failure in either thread is raised here.  Returns the number of
+    bytes written.
+    """
+    src_fd = open_device(src_path, os.O_RDONLY, direct)
+    try:
+        dest_fd = open_device(dest_path, os.O_WRONLY, direct)
+        try:
+            size = device_size(src_fd)
+            log.debug('Copying %s to %s: %d bytes, direct=%s, sparse=%s, '
+                      'verify=%s', src_path, dest_path, size, direct, sparse,
+                      verify)
+            digests = None
+            if verify:
+                digests = []
+            written = copy_chunks(src_fd, dest_fd, size, sparse, digests)
+            os.fsync(dest_fd)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+
+    if verify:
+        verify_device(dest_path, direct, digests)
+    return written
+
+
+def open_device(path, flags, direct):
+    if direct:
+        flags |= os.O_DIRECT
+    return os.open(path, flags)
+
+
+def device_size(fd):
+    size = os.lseek(fd, 0, 2)
+    os.lseek(fd, 0, 0)
+    return size
+
+
+def new_buffer():
+    """Returns a page-aligned buffer of CHUNK_SIZE bytes, as O_DIRECT
+    needs."""
+    return mmap.mmap(-1, CHUNK_SIZE)
+
+
+def read_chunk(f, buf):
+    """Reads up to CHUNK_SIZE bytes from file f into buf, returning the
+    number read, which is only short at the end of the device."""
+    n = f.readinto(buf)
+    return n or 0
+
+
+def copy_chunks(src_fd, dest_fd, size, sparse, digests):
+    free = Queue.Queue()
+    full = Queue.Queue()
+    for _ in range(READ_AHEAD):
+        free.put(new_buffer())
+    stop = threading.Event()
+    failures = []
+
+    reader = threading.Thread(target=read_chunks,
+                              args=(src_fd, free, full, stop, failures,
+                                    digests))
+    reader.setDaemon(True)
+    reader.start()
+
+    progress = CopyProgress(size)
+    reader_done = False
+    try:
+        while True:
+            item = full.get()
+            if item is None:
+                reader_done = True
+                break
+            offset, n, buf = item
+            chunk = buffer(buf, 0, n)
+            if sparse and chunk == buffer(ZEROS, 0, n):
+                progress.skipped += n
+            else:
+                os.lseek(dest_fd, offset, 0)
+                write_all(dest_fd, chunk)
+                progress.written += n
+            free.put(buf)
+            progress.update(offset + n)
+    finally:
+        if not reader_done:
+            # Stop the reader, handing back buffers until it has noticed.
+            stop.set()
+            item = full.get()
+            while item is not None:
+                free.put(item[2])
+                item = full.get()
+        reader.join()
+
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    progress.done()
+    return progress.written
+
+
+def read_chunks(src_fd, free, full, stop, failures, digests):
+    """
+    The reader thread.  Puts (offset, length, buffer) on full for each chunk,
+    and then None.  If reading fails, sys.exc_info() is put in failures
+    first.
+    """
+    try:
+        try:
+            f = os.fdopen(os.dup(src_fd), 'rb', 0)
+            try:
+                offset = 0
+                while not stop.isSet():
+                    buf = free.get()
+                    n = read_chunk(f, buf)
+                    if n == 0:
+                        break
+                    if digests is not None:
+                        digests.append(md5(buffer(buf, 0, n)).digest())
+                    full.put((offset, n, buf))
+                    offset += n
+            finally:
+                f.close()
+        except:
+            failures.append(sys.exc_info())
+    finally:
+        full.put(None)
+
+
+def write_all(fd, data):
+    i = 0
+    while i < len(data):
+        i += os.write(fd, buffer(data, i))
+
+
+def verify_device(dest_path, direct, digests):
+    log.debug('Verifying %s...', dest_path)
+    buf = new_buffer()
+    f = os.fdopen(open_device(dest_path, os.O_RDONLY, direct), 'rb', 0)
+    try:
+        offset = 0
+        for digest in digests:
+            n = read_chunk(f, buf)
+            if md5(buffer(buf, 0, n)).digest() != digest:
+                raise VerifyFailed(
+                    '%s does not match its source in the %d bytes at %d' %
+                    (dest_path, n, offset))
+            offset += n
+    finally:
+        f.close()
+    log.debug('Verifying %s done: %d chunks matched.', dest_path,
+              len(digests))
+
+
+class CopyProgress(object):
+    """Logs the progress of copy_chunks every PROGRESS_INTERVAL seconds."""
+    def __init__(self, size):
+        self.size = size
+        self.written = 0
+        self.skipped = 0
+        self.start = monotonic_time()
+        self.last = self.start
+
+    def update(self, offset):
+        now = monotonic_time()
+        if now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        rate = offset / max(now - self.start, 0.001)
+        log.debug('Copied %d of %d MiB (%d%%) at %.1f MiB/s, '
+                  '%d MiB skipped, ETA %d s.',
+                  offset / MiB, self.size / MiB,
+                  self.size and offset * 100 / self.size or 100,
+                  rate / MiB, self.skipped / MiB,
+                  rate and (self.size - offset) / rate or 0)
+
+    def done(self):
+        elapsed = max(monotonic_time() - self.start, 0.001)
+        log.info('Copied %d MiB in %d s (%.1f MiB/s): %d MiB written, '
+                 '%d MiB of zeros skipped.',
+                 (self.written + self.skipped) / MiB, elapsed,
+                 (self.written + self.skipped) / elapsed / MiB,
+                 self.written / MiB, self.skipped / MiB)
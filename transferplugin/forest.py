@@ -64,7 +64,7 @@ class Forest(object):
         return self._roots
 
 
-    def build(session, leaf_vdis, include_bitmaps=True):
+    def build(session, leaf_vdis, include_bitmaps=True, timer=None):
         srs = set([session.xenapi.VDI.get_SR(vdi_ref) for
                    vdi_ref in leaf_vdis.iterkeys()])
         for sr in srs:
@@ -83,7 +83,8 @@ class Forest(object):
             child_map[parent_ref].append(child_ref)
         bitmap_map = \
             include_bitmaps and \
-            vhd_bitmaps.get_all_bitmaps(session, leaf_vdis.iterkeys()) or \
+            vhd_bitmaps.get_all_bitmaps(session, leaf_vdis.iterkeys(),
+                                        timer) or \
             {}
         for node in child_map.iteritems():
             log.debug('%s%s has children %s',
@@ -0,0 +1,128 @@
+# Transfer VM - VPX for exposing VDIs on XenServer
+# Copyright (C) Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Reports what a plugin pays for its imports when it starts.
+
+    python /etc/xapi.d/plugins/transfer --import-cost
+
+runs the plugin's imports, as every call to it does, and prints how long
+each module took to import, both in all and without the modules that it
+imported in turn.  It then imports the modules that the plugin imports
+through lazy_import, which only the calls that use them pay for, and prints
+the same for those.  No call is made.
+
+This module is imported by the plugins before anything else, so it must
+import nothing that they would not.
+"""
+
+import __builtin__
+import sys
+import time
+
+
+FLAG = '--import-cost'
+
+# Whether the plugin was run with FLAG.
+enabled = False
+
+# An ImportRecord for each import that has started, in order.
+records = []
+# The records of the imports in progress, innermost last.
+stack = []
+# When start was called.
+start_time = None
+
+
+class ImportRecord(object):
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.seconds = 0.0
+        self.inner_seconds = 0.0
+        self.modules = 0
+
+
+##### Code
+
+def start():
+    """Called by the plugins before their imports.  If the plugin was run
+    with FLAG, removes it from the arguments and starts timing imports."""
+    global enabled, real_import, start_time
+    if sys.argv[1:] != [FLAG]:
+        return
+    enabled = True
+    del sys.argv[1:]
+    start_time = time.time()
+    real_import = __builtin__.__import__
+    __builtin__.__import__ = timed_import
+
+
+def timed_import(name, *args):
+    record = ImportRecord(name, len(stack))
+    records.append(record)
+    stack.append(record)
+    modules = count_modules()
+    start = time.time()
+    try:
+        return real_import(name, *args)
+    finally:
+        record.seconds = time.time() - start
+        record.modules = count_modules() - modules
+        stack.pop()
+        if stack:
+            stack[-1].inner_seconds += record.seconds
+
+
+def count_modules():
+    # Not len(sys.modules): that counts the None entries left by the
+    # implicit relative imports of packages, which imported nothing.
+    return len([m for m in sys.modules.values() if m is not None])
+
+
+def report(out=sys.stdout):
+    """Called by the plugins in place of dispatch when enabled."""
+    startup_seconds = time.time() - start_time
+    print_records(out, 'Imported at startup', records, startup_seconds)
+
+    import pluginlib
+    del records[:]
+    start = time.time()
+    for module in pluginlib.lazy_modules:
+        try:
+            module._load()
+        except Exception, exn:
+            out.write('Failed to import %s: %s\n' % (module._name, exn))
+    print_records(out, 'Imported on first use', records, time.time() - start)
+
+
+def print_records(out, title, recs, seconds):
+    out.write('%s: %.1f ms, %d modules\n\n' %
+              (title, seconds * 1000, sum([r.modules for r in recs
+                                           if r.depth == 0])))
+    out.write('%9s %9s %8s  %s\n' % ('total ms', 'self ms', 'modules',
+                                      'import'))
+    for r in recs:
+        # Imports of modules that were imported already cost next to
+        # nothing, and would bury the rest.
+        if r.modules == 0:
+            continue
+        out.write('%9.1f %9.1f %8d  %s%s\n' %
+                  (r.seconds * 1000, (r.seconds - r.inner_seconds) * 1000,
+                   r.modules, '  ' * r.depth, r.name))
+    out.write('\n')
@@ -0,0 +1,259 @@
+# Transfer VM - VPX for exposing VDIs on XenServer
+# Copyright (C) Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A cache in dom0 of the VM metadata in metadata VDIs.
+
+get_import_instructions and remap_vm both read the same metadata VDI, and
+each would otherwise plug it into dom0 and parse it.  The first to read it
+keeps a copy of its ova.xml here, as a tarball of its own, along with what
+scan_ova_xml made of it, under the VDI's uuid and the SHA1 of ova.xml.  The
+next call then needs neither the VDI nor the parse.
+
+The cache is kept only by the master of the metadata VDI's SR.
+get_import_instructions always runs there, and remap_vm goes there when
+that host can see the SR it imports into.  Elsewhere, remap_vm reads the VDI
+itself, and ignores this host's cache.  Whichever host writes or destroys a
+metadata VDI calls forget_metadata on the SR master to drop its entry.
+
+The SHA1 names the copy of ova.xml taken when the entry was stored, and is
+not checked against the VDI by lookup: the contents of a VDI cannot be
+checked without reading it, which is what the cache is there to avoid.  The
+hash therefore does not detect changes made to the VDI other than through
+this plugin.  Instead, an entry lasts no more than TTL_SECONDS, and is
+dropped by invalidate whenever the VDI is written or destroyed through this
+plugin.
+"""
+
+import cPickle
+import errno
+import os
+import tarfile
+import time
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from pluginlib import *
+
+import vm_metadata
+
+
+CACHE_DIR = '/var/run/transfervm/metadata/'
+
+# How long, in seconds, an entry is used for.
+TTL_SECONDS = 600
+
+# The size of each read when copying ova.xml.
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+##### Code
+
+class CacheEntry(object):
+    """
+    The cached metadata of one VDI.  ova_xml is the OvaXml from scan_ova_xml,
+    and open returns the copy of the tarball, for NewMetadataTarball.
+    """
+    def __init__(self, vdi_uuid, content_hash, created, ova_xml):
+        self.vdi_uuid = vdi_uuid
+        self.content_hash = content_hash
+        self.created = created
+        self.ova_xml = ova_xml
+
+    def tarball_path(self):
+        return tarball_path(self.vdi_uuid, self.content_hash)
+
+    def open(self):
+        return file(self.tarball_path(), 'rb')
+
+
+def lookup(vdi_uuid):
+    """Returns the CacheEntry for the given VDI, or None if there is none
+    that is still fresh."""
+    try:
+        f = file(info_path(vdi_uuid), 'rb')
+        try:
+            content_hash, created, vdis, networks = cPickle.load(f)
+        finally:
+            f.close()
+    except IOError:
+        return None
+    except Exception, exn:
+        log.warn('Ignoring corrupt metadata cache entry for %s: %s',
+                 vdi_uuid, exn)
+        invalidate(vdi_uuid)
+        return None
+
+    age = time.time() - created
+    if age > TTL_SECONDS or age < 0:
+        log.debug('Metadata cache entry for %s is %d s old; dropping it.',
+                  vdi_uuid, age)
+        invalidate(vdi_uuid)
+        return None
+    entry = CacheEntry(vdi_uuid, content_hash, created,
+                       vm_metadata.OvaXml(vdis, networks))
+    if not os.path.exists(entry.tarball_path()):
+        return None
+    log.debug('Using cached metadata for %s (ova.xml SHA1 %s).', vdi_uuid,
+              content_hash)
+    return entry
+
+
+def store(vdi_uuid, vm_metadata_file):
+    """
+    Copies ova.xml from the given VM export tarball, which holds the metadata
+    in the given VDI, into the cache, and scans it.  Returns the new
+    CacheEntry.
+    """
+    make_cache_dir()
+    reap()
+    invalidate(vdi_uuid)
+    tmp_path = '%s%s.%d.tmp' % (CACHE_DIR, vdi_uuid, os.getpid())
+    try:
+        content_hash = copy_ova_xml(vm_metadata_file, tmp_path)
+        f = file(tmp_path, 'rb')
+        try:
+            ova_xml = vm_metadata.scan_ova_xml(f)
+        finally:
+            f.close()
+        entry = CacheEntry(vdi_uuid, content_hash, time.time(), ova_xml)
+        os.rename(tmp_path, entry.tarball_path())
+    except:
+        remove(tmp_path)
+        raise
+
+    try:
+        write_atomically(info_path(vdi_uuid),
+                         cPickle.dumps((entry.content_hash, entry.created,
+                                        ova_xml.vdis, ova_xml.networks), 2))
+    except:
+        remove(entry.tarball_path())
+        raise
+    log.debug('Cached metadata for %s (ova.xml SHA1 %s).', vdi_uuid,
+              content_hash)
+    return entry
+
+
+def invalidate(vdi_uuid):
+    """Nothrow guarantee.  Drops anything cached for the given VDI."""
+    remove(info_path(vdi_uuid))
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    prefix = vdi_uuid + '-'
+    for name in names:
+        if name.startswith(prefix) and name.endswith('.tar'):
+            remove(CACHE_DIR + name)
+
+
+def reap():
+    """Drops the entries that have outlived TTL_SECONDS, and anything left
+    behind by a store that failed."""
+    now = time.time()
+    for name in os.listdir(CACHE_DIR):
+        try:
+            age = now - os.stat(CACHE_DIR + name).st_mtime
+        except OSError:
+            continue
+        if age <= TTL_SECONDS:
+            continue
+        if name.endswith('.info'):
+            invalidate(name[:-len('.info')])
+        elif name.endswith('.tar') or name.endswith('.tmp'):
+            # Left behind by a store that failed before writing the info.
+            remove(CACHE_DIR + name)
+
+
+def copy_ova_xml(vm_metadata_file, path):
+    """Writes a tarball holding just the ova.xml from the given one to path,
+    and returns the SHA1 of ova.xml."""
+    digest = sha1()
+    src_tf = tarfile.open(mode='r:', fileobj=vm_metadata_file)
+    try:
+        ti = src_tf.getmember('ova.xml')
+        src = src_tf.extractfile(ti)
+        try:
+            out_file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT |
+                                         os.O_TRUNC, 0600), 'wb')
+            try:
+                dest_tf = tarfile.open(mode='w:', fileobj=out_file)
+                try:
+                    dest_ti = tarfile.TarInfo(name='ova.xml')
+                    dest_ti.size = ti.size
+                    dest_tf.addfile(dest_ti, HashingFile(src, digest))
+                finally:
+                    dest_tf.close()
+            finally:
+                out_file.close()
+        finally:
+            src.close()
+    finally:
+        src_tf.close()
+    return digest.hexdigest()
+
+
+class HashingFile(object):
+    """Reads from the given file, adding what is read to the given digest."""
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+
+    def read(self, n=COPY_CHUNK_SIZE):
+        data = self.f.read(n)
+        self.digest.update(data)
+        return data
+
+
+def info_path(vdi_uuid):
+    return '%s%s.info' % (CACHE_DIR, vdi_uuid)
+
+
+def tarball_path(vdi_uuid, content_hash):
+    return '%s%s-%s.tar' % (CACHE_DIR, vdi_uuid, content_hash)
+
+
+def make_cache_dir():
+    if not os.path.exists(CACHE_DIR):
+        try:
+            os.makedirs(CACHE_DIR)
+        except OSError:
+            # Someone else created it first.
+            pass
+
+
+def write_atomically(path, data):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError, exn:
+        if exn.errno != errno.ENOENT:
+            log.warn('Ignoring failure to remove %s: %s', path, exn)
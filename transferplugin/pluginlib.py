@@ -16,9 +16,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import atexit
+import errno
 import logging
 import logging.handlers
+import os
 import re
+import sys
 import time
 import xmlrpclib
 
@@ -84,6 +88,55 @@ def log_exceptions(func):
     return decorated
 
 
+##### Lazy imports
+
+# Every LazyModule made so far.
+lazy_modules = []
+
+
+class LazyModule(object):
+    """
+    Stands in for the module of the given name, which is imported when one
+    of its attributes is first used.  xapi runs each plugin call as a process
+    of its own, so a plugin's imports are paid for on every call, whether the
+    call uses them or not; the modules that only some calls use are imported
+    through these.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def _load(self):
+        if self._module is None:
+            __import__(self._name)
+            self.__dict__['_module'] = sys.modules[self._name]
+        return self._module
+
+
+def lazy_import(name):
+    """Returns a LazyModule for the module of the given, possibly dotted,
+    name."""
+    module = LazyModule(name)
+    lazy_modules.append(module)
+    return module
+
+
+def import_lazy_modules():
+    """
+    Nothrow guarantee.  Imports every module that lazy_import has been asked
+    for, for transferd, whose calls are forked from it already warm.  Any
+    that fail are left to fail again when first used, as they would have.
+    """
+    for module in lazy_modules:
+        try:
+            module._load()
+        except Exception, exn:
+            log.warn('Failed to import %s: %s', module._name, exn)
+
+
 ##### Helpers
 
 def ignore_failure(func, *args, **kwargs):
@@ -122,6 +175,246 @@ def call_plugin(session, plugin, fn, args):
         host_ref, plugin, fn, args)
 
 
+def is_alive(pid):
+    """Returns whether the given process is still running, for the dom0
+    files that record which processes are using an entry."""
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError, exn:
+        return exn.errno != errno.ESRCH
+
+
+def session_for_thread(session):
+    """Returns a new local session object sharing the given session's handle.
+    xmlrpclib connections must not be shared between threads, so each thread
+    making XenAPI calls needs one of these.  It must not be logged out."""
+    result = XenAPI.xapi_local()
+    result._session = session.handle
+    return result
+
+
+##### Timing
+
+def monotonic_time():
+    """Returns a time in seconds that is unaffected by changes to the system
+    clock.  os.times()[4] comes from times(2), which counts clock ticks since
+    boot."""
+    return os.times()[4]
+
+
+class PhaseTimer(object):
+    """
+    Records how long each phase of an operation takes, using monotonic_time.
+    Phases are reported in the order in which they were first timed; timing
+    the same phase again adds to its total.  Phases may nest, in which case
+    the outer phase includes the time of the inner one.
+    """
+
+    def __init__(self):
+        self._start = monotonic_time()
+        self._stop = None
+        self._phases = []
+        self._durations = {}
+
+    def time(self, phase, f, *args, **kwargs):
+        """Calls f with the given arguments, adding the time taken to the
+        given phase, and returns its result."""
+        start = monotonic_time()
+        try:
+            result = f(*args, **kwargs)
+        finally:
+            self.add(phase, monotonic_time() - start)
+        report_phase(phase)
+        return result
+
+    def add(self, phase, seconds):
+        if phase not in self._durations:
+            self._phases.append(phase)
+            self._durations[phase] = 0.0
+        self._durations[phase] += seconds
+
+    def stop(self):
+        """Stops the clock for the total, which thereafter covers only the
+        time until now."""
+        self._stop = monotonic_time()
+
+    def elapsed(self):
+        """Returns the seconds since the timer was created, or until it was
+        stopped."""
+        if self._stop is None:
+            return monotonic_time() - self._start
+        return self._stop - self._start
+
+    def copy(self):
+        """Returns a new, running timer with the same phases as this one,
+        whose total carries on from this one's."""
+        result = PhaseTimer()
+        result._start = monotonic_time() - self.elapsed()
+        for phase in self._phases:
+            result.add(phase, self._durations[phase])
+        return result
+
+    def items(self):
+        """Returns a list of (phase, seconds) pairs, followed by
+        ('total', elapsed())."""
+        result = [(phase, self._durations[phase]) for phase in self._phases]
+        result.append(('total', self.elapsed()))
+        return result
+
+    def to_string(self, separator=','):
+        """Returns the timings as phase=seconds pairs, joined by the given
+        separator."""
+        return separator.join(['%s=%.3f' % (phase, seconds)
+                               for phase, seconds in self.items()])
+
+
+def parse_timings(s):
+    """Parse the output of PhaseTimer.to_string() back into a list of
+    (phase, seconds) strings."""
+    if not s:
+        return []
+    return [tuple(pair.split('=', 1)) for pair in s.split(',')]
+
+
+##### Asynchronous calls
+
+# The AsyncTask that this process is running, if it is running one.
+current_task = None
+
+
+class AsyncTask(object):
+    """
+    A xapi task, reporting on a plugin call that run_async is running in a
+    process of its own.  Progress comes from the phases of the call that
+    PhaseTimer sees completing, as a share of the given list of phases, or
+    straight from report_progress.
+
+    Hosts whose xapi cannot set the status, result or progress of a task
+    get them in the task's other_config instead, under the keys
+    transfer_status, transfer_result, transfer_error_info and
+    transfer_progress.
+    """
+    def __init__(self, session, task_ref, phases):
+        self.session = session
+        self.task_ref = task_ref
+        self.phases = phases or []
+        self.phases_done = []
+
+    def phase_done(self, phase):
+        if phase in self.phases and phase not in self.phases_done:
+            self.phases_done.append(phase)
+            # The call is not done until it returns.
+            self.progress(0.99 * len(self.phases_done) / len(self.phases))
+
+    def progress(self, progress):
+        self.set('progress', float(progress), str(progress))
+
+    def succeed(self, result):
+        self.set('result', result, result)
+        self.progress(1.0)
+        self.set('status', 'success', 'success')
+
+    def fail(self, error_info):
+        self.set('error_info', error_info, repr(error_info))
+        self.set('status', 'failure', 'failure')
+
+    def set(self, field, value, config_value):
+        """Nothrow guarantee."""
+        task = self.session.xenapi.task
+        try:
+            try:
+                getattr(task, 'set_' + field)(self.task_ref, value)
+            except XenAPI.Failure, exn:
+                if exn.details[0] != 'MESSAGE_METHOD_UNKNOWN':
+                    raise
+                key = 'transfer_' + field
+                other_config = task.get_other_config(self.task_ref)
+                if key in other_config:
+                    task.remove_from_other_config(self.task_ref, key)
+                task.add_to_other_config(self.task_ref, key, config_value)
+        except Exception, exn:
+            log.warn('Ignoring failure to set %s of task %s: %s', field,
+                     self.task_ref, exn)
+
+
+def run_async(session, name, f, args, phases=None):
+    """
+    Creates a xapi task called name, and returns it at once, having started a
+    detached process that calls f(session, args), as the plugin call named
+    name would.  That process logs in to xapi itself, as the caller's session
+    may not last, and sets the task's result to what f returns, or fails
+    the task with f's error.  See AsyncTask for progress.
+    """
+    task_ref = session.xenapi.task.create(name, '')
+    log.debug('Running %s asynchronously as task %s.', name, task_ref)
+    pid = os.fork()
+    if pid == 0:
+        # Leave the session and process group of xapi's plugin call, and let
+        # the plugin call return, with its output closed, once the
+        # grandchild has started.
+        try:
+            try:
+                os.setsid()
+                if os.fork() == 0:
+                    detach_stdio()
+                    run_task(name, task_ref, f, args, phases)
+            except Exception, exn:
+                log.error('Failed to start task %s: %s', task_ref, exn)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    return task_ref
+
+
+def detach_stdio():
+    null_fd = os.open('/dev/null', os.O_RDWR)
+    for fd in [0, 1, 2]:
+        os.dup2(null_fd, fd)
+    os.close(null_fd)
+
+
+def run_task(name, task_ref, f, args, phases):
+    global current_task
+    session = XenAPI.xapi_local()
+    session.login_with_password('root', '')
+    try:
+        current_task = AsyncTask(session, task_ref, phases)
+        try:
+            result = f(session, args)
+        except XenAPI.Failure, exn:
+            log.error('%s: XenAPI.Failure: %s', name, exn)
+            current_task.fail(exn.details)
+        except Exception, exn:
+            log.error('%s: %s: %s', name, exn.__class__.__name__, exn)
+            current_task.fail(['XENAPI_PLUGIN_EXCEPTION', name,
+                               exn.__class__.__name__, str(exn)])
+        else:
+            log.debug('%s: task %s succeeded.', name, task_ref)
+            current_task.succeed(result)
+    finally:
+        current_task = None
+        detach_all_from_dom0()
+        try:
+            session.xenapi.session.logout()
+        except Exception, exn:
+            log.warn('Ignoring exception when logging out: %s', exn)
+
+
+def report_phase(phase):
+    """Nothrow guarantee.  Tells the task this process is running for, if
+    any, that the given phase is done."""
+    if current_task is not None:
+        current_task.phase_done(phase)
+
+
+def report_progress(progress):
+    """Nothrow guarantee.  Sets the progress, from 0.0 to 1.0, of the task
+    this process is running for, if any."""
+    if current_task is not None:
+        current_task.progress(progress)
+
+
 ##### Argument validation
 
 ARGUMENT_PATTERN = re.compile(r'^[a-zA-Z0-9_:\.\-,]+$')
@@ -242,7 +535,30 @@ def optional(args, key):
     return key in args and args[key] or None
 
 
+# How long each event.from call in wait_for_task_complete waits, in seconds.
+TASK_EVENT_TIMEOUT = 30.0
+
+
 def wait_for_task_complete(session, task_ref):
+    """Waits for the given task to finish, and returns its status.  The task
+    is watched with event.from, or polled every second where xapi does not
+    have that."""
+    event_from = getattr(session.xenapi.event, 'from')
+    token = ''
+    while True:
+        status = session.xenapi.task.get_status(task_ref)
+        if status in ['success', 'failure', 'cancelled']:
+            return status
+        try:
+            token = event_from(['task/%s' % task_ref], token,
+                               TASK_EVENT_TIMEOUT)['token']
+        except XenAPI.Failure, exn:
+            if exn.details[0] != 'MESSAGE_METHOD_UNKNOWN':
+                raise
+            return poll_for_task_complete(session, task_ref)
+
+
+def poll_for_task_complete(session, task_ref):
     while True:
         status = session.xenapi.task.get_status(task_ref)
         if status in ['success', 'failure', 'cancelled']:
@@ -317,7 +633,54 @@ def create_vdi(session, sr_ref, name_label, virtual_size, read_only):
     return vdi_ref
 
 
+class Dom0Attachment(object):
+    """A VBD plugging a VDI into dom0, and how many callers are using it."""
+    def __init__(self, session, vdi, read_only, vbd, device):
+        self.session = session
+        self.vdi = vdi
+        self.read_only = read_only
+        self.vbd = vbd
+        self.device = device
+        self.users = 0
+
+
+# The Dom0Attachments that this process has made, by (VDI, read_only).
+dom0_attachments = {}
+
+
 def with_vdi_in_dom0(session, vdi, read_only, f):
+    """
+    Plug the given VDI into dom0, and call f with the device name.
+
+    A plug of the same VDI in the same mode that this process has already
+    made is reused.  Read-only plugs are kept once f returns, in case the
+    VDI is wanted again, until detach_from_dom0 is called for the VDI or the
+    plugin exits.  Read-write plugs are unplugged as soon as their last user
+    is done, so that nothing else is kept from the VDI.
+    """
+    attachment = attach_to_dom0(session, vdi, read_only)
+    try:
+        return f(attachment.device)
+    finally:
+        attachment.users -= 1
+        if attachment.users == 0 and not read_only:
+            unplug_attachment(attachment)
+
+
+def attach_to_dom0(session, vdi, read_only):
+    key = (vdi, read_only)
+    attachment = dom0_attachments.get(key)
+    if attachment is not None:
+        log.debug('Reusing VBD %s for VDI %s.', attachment.vbd, vdi)
+        attachment.users += 1
+        return attachment
+
+    if not read_only:
+        # An idle read-only plug would stop a read-write one.
+        idle = dom0_attachments.get((vdi, True))
+        if idle is not None and idle.users == 0:
+            unplug_attachment(idle)
+
     dom0 = get_domain_0(session)
     vbd_rec = {}
     vbd_rec['VM'] = dom0
@@ -339,19 +702,63 @@ def with_vdi_in_dom0(session, vdi, read_only, f):
         log.debug('Plugging VBD %s ... ', vbd)
         session.xenapi.VBD.plug(vbd)
         log.debug('Plugging VBD %s done.', vbd)
-        return f(session.xenapi.VBD.get_device(vbd))
-    finally:
-        log.debug('Destroying VBD for VDI %s ... ', vdi)
+        device = session.xenapi.VBD.get_device(vbd)
+    except:
         vbd_unplug_with_retry(session, vbd)
         ignore_failure(session.xenapi.VBD.destroy, vbd)
-        log.debug('Destroying VBD for VDI %s done.', vdi)
+        raise
+    attachment = Dom0Attachment(session, vdi, read_only, vbd, device)
+    attachment.users = 1
+    dom0_attachments[key] = attachment
+    return attachment
+
+
+def unplug_attachment(attachment):
+    """Nothrow guarantee.  Unplugs and destroys the attachment's VBD."""
+    key = (attachment.vdi, attachment.read_only)
+    if dom0_attachments.get(key) is attachment:
+        del dom0_attachments[key]
+    log.debug('Destroying VBD for VDI %s ... ', attachment.vdi)
+    try:
+        vbd_unplug_with_retry(attachment.session, attachment.vbd)
+        ignore_failure(attachment.session.xenapi.VBD.destroy, attachment.vbd)
+    except Exception, exn:
+        log.error('Ignoring failure to destroy VBD %s: %s', attachment.vbd,
+                  exn)
+        return
+    log.debug('Destroying VBD for VDI %s done.', attachment.vdi)
+
+
+def detach_from_dom0(vdi=None):
+    """Unplug the idle plugs of the given VDI, or of all VDIs, that
+    with_vdi_in_dom0 has kept, as must be done before a VDI is destroyed or
+    handed to another VM, say."""
+    for attachment in dom0_attachments.values():
+        if attachment.users == 0 and (vdi is None or attachment.vdi == vdi):
+            unplug_attachment(attachment)
+
+
+def detach_all_from_dom0():
+    """Nothrow guarantee.  Unplug everything that with_vdi_in_dom0 has kept.
+    This is run when the plugin exits."""
+    for attachment in dom0_attachments.values():
+        unplug_attachment(attachment)
+
+atexit.register(detach_all_from_dom0)
+
+
+# The first and longest waits, in seconds, between tries of VBD.unplug.
+UNPLUG_RETRY_DELAY = 0.1
+UNPLUG_RETRY_MAX_DELAY = 5.0
 
 
 def vbd_unplug_with_retry(session, vbd):
     """Call VBD.unplug on the given VBD, with a retry if we get
     DEVICE_DETACH_REJECTED.  For reasons which I don't understand, we're
     seeing the device still in use, even when all processes using the device
-    should be dead."""
+    should be dead.  The wait between tries doubles each time, from
+    UNPLUG_RETRY_DELAY up to UNPLUG_RETRY_MAX_DELAY."""
+    delay = UNPLUG_RETRY_DELAY
     while True:
         try:
             session.xenapi.VBD.unplug(vbd)
@@ -360,8 +767,10 @@ def vbd_unplug_with_retry(session, vbd):
         except XenAPI.Failure, e:
             if (len(e.details) > 0 and
                     e.details[0] == 'DEVICE_DETACH_REJECTED'):
-                log.debug('VBD.unplug rejected: retrying...')
-                time.sleep(1)
+                log.debug('VBD.unplug rejected: retrying in %.1f s...',
+                          delay)
+                time.sleep(delay)
+                delay = min(delay * 2, UNPLUG_RETRY_MAX_DELAY)
             elif (len(e.details) > 0 and
                   e.details[0] == 'DEVICE_ALREADY_DETACHED'):
                 log.debug('VBD.unplug successful eventually.')
@@ -414,17 +823,65 @@ def get_sr_ref(session, vdi_uuid):
     sr = session.xenapi.VDI.get_SR(vdi_ref)
     return sr
 
-def write_sr_config(session, vdi_uuid):
-    remove_sr_config(session, vdi_uuid) #Removing config for VDI if it wasn't removed properly
-    log.debug("Writing SR Config..%s", vdi_uuid)
-    key = "tvm_%s" % (vdi_uuid)
-    sr = get_sr_ref(session, vdi_uuid)
-    log.debug("Adding key value pair %s=%s for SR %s", key, vdi_uuid, sr)
-    session.xenapi.SR.add_to_other_config(sr, key, 'true')
+def sr_fence_key(vdi_uuid):
+    return "tvm_%s" % vdi_uuid
+
+
+def fence_srs(session, vdi_recs):
+    """
+    Keep storage GC off the SRs of the given VDI records while their VHDs are
+    read: each VDI gets a tvm_<uuid> key in its SR's other_config, and GC is
+    aborted with one abort_sr_ops call to the master of each SR.  Returns a
+    dictionary of SR ref -> VDI uuids, which must be handed to unfence_srs.
+    If this fails, whatever it did is undone.
+    """
+    fence = {}
+    for vdi_rec in vdi_recs:
+        vdi_uuids = fence.setdefault(vdi_rec['SR'], [])
+        if vdi_rec['uuid'] not in vdi_uuids:
+            vdi_uuids.append(vdi_rec['uuid'])
+
+    try:
+        for sr, vdi_uuids in fence.iteritems():
+            fence_sr(session, sr, vdi_uuids)
+    except:
+        exc_info = sys.exc_info()
+        ignore_failure(unfence_srs, session, fence)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return fence
+
+
+def fence_sr(session, sr, vdi_uuids):
+    # The keys are added one at a time, rather than with one
+    # SR.set_other_config, which could lose the keys of anyone else fencing
+    # this SR at the same time.
+    other_config = session.xenapi.SR.get_other_config(sr)
+    for vdi_uuid in vdi_uuids:
+        key = sr_fence_key(vdi_uuid)
+        #Removing config for VDI if it wasn't removed properly
+        for k in other_config:
+            if k.startswith(key):
+                session.xenapi.SR.remove_from_other_config(sr, k)
+        log.debug("Adding key value pair %s=true for SR %s", key, sr)
+        session.xenapi.SR.add_to_other_config(sr, key, 'true')
     host_sr_master = get_sr_master(session, sr)
     args = {}
     args['sr_uuid'] = session.xenapi.SR.get_uuid(sr)
-    session.xenapi.host.call_plugin(host_sr_master, 'transfer', 'abort_sr_ops', args)
+    session.xenapi.host.call_plugin(host_sr_master, 'transfer', 'abort_sr_ops',
+                                    args)
+
+
+def unfence_srs(session, fence):
+    """Remove the keys that fence_srs added, allowing GC and other storage
+    scripts to run when started."""
+    for sr, vdi_uuids in fence.iteritems():
+        keys = [sr_fence_key(vdi_uuid) for vdi_uuid in vdi_uuids]
+        for k in session.xenapi.SR.get_other_config(sr):
+            for key in keys:
+                if k.startswith(key):
+                    session.xenapi.SR.remove_from_other_config(sr, k)
+                    break
+
 
 def remove_sr_config(session, vdi_uuid):
     """For a given vdi_uuid, this function checks if there exists an other-config
@@ -432,7 +889,7 @@ def remove_sr_config(session, vdi_uuid):
        storage scripts to run when started.
     """
     sr = get_sr_ref(session, vdi_uuid)
-    key = "tvm_%s" % (vdi_uuid)
+    key = sr_fence_key(vdi_uuid)
     other_config = session.xenapi.SR.get_other_config(sr)
     for pair in other_config:
         if pair.startswith(key):
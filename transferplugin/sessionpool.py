@@ -0,0 +1,252 @@
+# Transfer VM - VPX for exposing VDIs on XenServer
+# Copyright (C) Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A pool of XenAPI sessions to remote pools, shared between plugin calls.
+
+Each plugin call is a process of its own, so the pool lives in a file in
+dom0, holding the handle of one session for each remote URL and set of
+credentials, the processes using it, and when it was last released.  A
+session is checked before being handed out, and one that has been idle for
+IDLE_SECONDS with no live process using it is logged out by the next call
+to acquire or release, or by reap_idle, which the transfer plugin's cleanup
+calls make, as does every expose.
+
+The handles of live sessions on the remote pools are thereby written to
+disk in dom0, where they give whoever reads them the rights of the
+credentials they were logged in with until they are logged out.  The pool
+file is only readable by root.
+"""
+
+import fcntl
+import os
+import time
+
+try:
+    from hashlib import sha256
+except ImportError:
+    from sha import new as sha256
+
+import XenAPI
+
+from pluginlib import *
+
+
+POOL_DIR = '/var/run/transfervm/'
+POOL_PATH = POOL_DIR + 'sessions'
+POOL_LOCK_PATH = POOL_DIR + 'sessions.lock'
+
+# How long, in seconds, an unused session is kept for.
+IDLE_SECONDS = 300
+
+
+##### Code
+
+def acquire(url, username, password):
+    """
+    Returns a session for the given URL and credentials, reusing a pooled one
+    if it is still valid, or else logging in.  It must be handed back to
+    release.
+    """
+    key = pool_key(url, username, password)
+    entries = lock_pool()
+    try:
+        entry = entries.get(key)
+        if entry is not None:
+            entry['pids'].append(os.getpid())
+        reaped = reap(entries)
+    finally:
+        unlock_pool(entries)
+    logout_all(reaped)
+
+    if entry is not None:
+        session = XenAPI.Session(url)
+        session._session = entry['handle']
+        try:
+            session.xenapi.session.get_this_host(entry['handle'])
+            log.debug('Reusing pooled session for %s.', url)
+            session.pool_key = key
+            return session
+        except Exception, exn:
+            log.debug('Pooled session for %s is no longer valid: %s', url,
+                      exn)
+            forget(key, entry['handle'])
+
+    session = XenAPI.Session(url)
+    session.login_with_password(username, password)
+    session.pool_key = key
+    entries = lock_pool()
+    try:
+        if key not in entries:
+            entries[key] = {'url': url,
+                            'handle': session._session,
+                            'last_used': time.time(),
+                            'pids': [os.getpid()]}
+        else:
+            # Someone else pooled a session while we were logging in; ours
+            # will be logged out on release.
+            session.pool_key = None
+    finally:
+        unlock_pool(entries)
+    return session
+
+
+def release(session):
+    """
+    Nothrow guarantee.  Hands a session from acquire back to the pool, or
+    logs it out if it is not pooled.
+    """
+    key = getattr(session, 'pool_key', None)
+    reaped = []
+    pooled = False
+    try:
+        entries = lock_pool()
+        try:
+            entry = entries.get(key)
+            if entry is not None and entry['handle'] == session._session:
+                pooled = True
+                if os.getpid() in entry['pids']:
+                    entry['pids'].remove(os.getpid())
+                entry['last_used'] = time.time()
+            reaped = reap(entries)
+        finally:
+            unlock_pool(entries)
+    except Exception, exn:
+        log.warn('Ignoring exception when releasing session: %s', exn)
+    if not pooled:
+        logout_all([(None, session)])
+    logout_all(reaped)
+
+
+def pool_key(url, username, password):
+    # The credentials are part of the key, so that a session is only ever
+    # handed to a caller who could have logged in with them.
+    return sha256('\0'.join([url, username, password])).hexdigest()
+
+
+def forget(key, handle):
+    entries = lock_pool()
+    try:
+        if key in entries and entries[key]['handle'] == handle:
+            del entries[key]
+    finally:
+        unlock_pool(entries)
+
+
+def reap_idle(idle_seconds=IDLE_SECONDS):
+    """
+    Nothrow guarantee.  Logs out the pooled sessions that have been idle for
+    the given number of seconds, with no live process using them.
+    """
+    reaped = []
+    try:
+        entries = lock_pool()
+        try:
+            reaped = reap(entries, idle_seconds)
+        finally:
+            unlock_pool(entries)
+    except Exception, exn:
+        log.warn('Ignoring exception when reaping pooled sessions: %s', exn)
+    logout_all(reaped)
+
+
+def reap(entries, idle_seconds=IDLE_SECONDS):
+    """
+    Removes the entries that have been idle for the given number of seconds,
+    with no live process using them, and returns (url, session) for each.
+    """
+    now = time.time()
+    result = []
+    for key, entry in entries.items():
+        entry['pids'] = [p for p in entry['pids'] if is_alive(p)]
+        if not entry['pids'] and now - entry['last_used'] >= idle_seconds:
+            log.debug('Logging out pooled session for %s, idle for %d s.',
+                      entry['url'], now - entry['last_used'])
+            session = XenAPI.Session(entry['url'])
+            session._session = entry['handle']
+            result.append((entry['url'], session))
+            del entries[key]
+    return result
+
+
+def logout_all(sessions):
+    for url, session in sessions:
+        try:
+            session.xenapi.session.logout()
+        except Exception, exn:
+            log.warn('Ignoring exception when logging out of %s: %s', url,
+                     exn)
+
+
+class PoolEntries(dict):
+    """The pool's entries, along with the lock file that protects them."""
+    pass
+
+
+def lock_pool():
+    """Takes the pool lock, and returns the entries, which must be passed to
+    unlock_pool to write them back and release the lock."""
+    if not os.path.exists(POOL_DIR):
+        try:
+            os.makedirs(POOL_DIR)
+        except OSError:
+            # Someone else created it first.
+            pass
+    lock_file = open(POOL_LOCK_PATH, 'w')
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    entries = PoolEntries()
+    entries.lock_file = lock_file
+    try:
+        f = open(POOL_PATH, 'r')
+        try:
+            for line in f:
+                key, url, handle, last_used, pids = line.split()
+                entries[key] = {'url': url,
+                                'handle': handle,
+                                'last_used': float(last_used),
+                                'pids': [int(p) for p in pids.split(',')
+                                         if p != '-']}
+        finally:
+            f.close()
+    except IOError:
+        # No pool yet.
+        pass
+    except ValueError, exn:
+        log.warn('Ignoring corrupt session pool: %s', exn)
+        entries.clear()
+    return entries
+
+
+def unlock_pool(entries):
+    lock_file = entries.lock_file
+    try:
+        tmp_path = POOL_PATH + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'w')
+        try:
+            for key, entry in entries.iteritems():
+                f.write('%s %s %s %f %s\n' %
+                        (key, entry['url'], entry['handle'],
+                         entry['last_used'],
+                         ','.join([str(p) for p in entry['pids']]) or '-'))
+        finally:
+            f.close()
+        os.rename(tmp_path, POOL_PATH)
+    finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+#
+# Transfer VM - VPX for exposing VDIs on XenServer
+# Copyright (C) Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+An optional daemon in dom0 that runs the calls to the transfer and copy
+plugins, so that they do not each pay for starting Python and importing
+XenAPI, the SM libraries, ssl and the rest of the plugins.
+
+    python /etc/xapi.d/plugins/transferd.py start|stop|status|run
+
+The daemon imports the plugins once, and listens on SOCKET_PATH.  xapi still
+runs a plugin for each call, but the plugin calls forward before its own
+imports: if the daemon is listening, the call is sent to it, and the plugin
+prints what comes back and exits.  If it is not, or it turns the call down,
+the plugin carries on and makes the call itself, as it always has.
+
+The daemon forks a child for each call, from its warm state, which runs the
+call through XenAPIPlugin.dispatch just as the plugin would have, with its
+output going back down the socket.  Calls thereby share nothing that they
+would not have shared as processes of their own: the state kept between
+them is in the same dom0 files as ever (sessionpool, metadata_cache, the
+template cache).
+
+What is warm, then, is the interpreter and the imported modules, and
+nothing else.  The daemon holds no XenAPI sessions of its own, since xapi
+hands each call the session it is to use.  Nor does it keep an index of the
+Transfer VMs or subscribe to xapi events: a child cannot hand what it
+learns back to the daemon, and the calls find the Transfer VMs with a
+single get_all_records_where already.  Keeping that state would mean
+serving calls from threads in one process, where the plugins' per-process
+globals (dom0 VBD attachments, the current async task) would be shared
+between calls, and where one call that fails badly could take down the
+rest.
+
+The protocol is a line "<plugin> <length>\\n", followed by that many bytes
+of XML-RPC request from xapi.  The reply is a line "OK\\n"; or "STALE\\n",
+"BUSY\\n" or "UNKNOWN\\n", for the plugin to make the call itself.  After
+"OK\\n", the plugin sends "GO\\n", and then reads the plugin's output up to
+EOF.  The plugin waits no more than REPLY_TIMEOUT_SECONDS for the daemon
+before sending "GO\\n", so that a daemon that is wedged costs a call no more
+than that, and then gives up and makes the call itself.  The daemon runs
+nothing until it has "GO\\n", which comes at once unless the plugin has
+given up and closed the socket instead, so the call is made once either way.
+"""
+
+import errno
+import os
+import signal
+import socket
+import sys
+import time
+
+
+PLUGIN_DIR = '/etc/xapi.d/plugins/'
+PLUGINS = ['transfer', 'copy']
+DAEMON_PATH = PLUGIN_DIR + 'transferd.py'
+
+# The plugins are loaded as modules with this prefix on their names.
+MODULE_PREFIX = '_transferd_'
+
+STATE_DIR = '/var/run/transfervm/'
+SOCKET_PATH = STATE_DIR + 'transferd.sock'
+PID_PATH = STATE_DIR + 'transferd.pid'
+
+# How many calls may be running at once.  Calls beyond that are turned down,
+# for the plugins to make themselves.
+MAX_CHILDREN = 256
+# How many connections may wait to be accepted.
+LISTEN_BACKLOG = 64
+
+# How long, in seconds, a plugin waits for each reply from the daemon before
+# making the call itself, and the daemon waits for each part of the request.
+REPLY_TIMEOUT_SECONDS = 5
+
+# How long, in seconds, stop waits for the daemon to exit.
+STOP_TIMEOUT_SECONDS = 10
+
+
+##### Plugin side
+
+def forward(plugin):
+    """
+    Called by the given plugin before its imports.  Hands this plugin call to
+    the daemon, if it is listening, and exits with what the call printed.
+    Returns if the daemon is not listening, did not take the call, or did
+    not answer in time, for the plugin to make the call itself.
+    """
+    if len(sys.argv) != 2:
+        return
+    request = sys.argv[1]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.settimeout(REPLY_TIMEOUT_SECONDS)
+            sock.connect(SOCKET_PATH)
+            sock.sendall('%s %d\n' % (plugin, len(request)) + request)
+            f = sock.makefile('rb')
+            if f.readline() != 'OK\n':
+                return
+            sock.sendall('GO\n')
+        except socket.error:
+            # socket.timeout included.
+            return
+
+        # The call is being made, so there is no going back from here.
+        sock.settimeout(None)
+        try:
+            while True:
+                data = f.read(64 * 1024)
+                if not data:
+                    break
+                sys.stdout.write(data)
+        except socket.error, exn:
+            print_failure(request, exn)
+        f.close()
+    finally:
+        sock.close()
+    sys.stdout.flush()
+    sys.exit(0)
+
+
+def print_failure(request, exn):
+    import xmlrpclib
+    import XenAPIPlugin
+    methodname = xmlrpclib.loads(request)[1]
+    print XenAPIPlugin.failure_message('XENAPI_PLUGIN_FAILURE',
+                                       [methodname, 'TransferdFailure',
+                                        'Lost the connection to transferd: '
+                                        '%s' % exn])
+
+
+##### Daemon side
+
+# This is only needed by the daemon, and is imported by it, so that the
+# plugins do not pay for XenAPI before forwarding.
+pluginlib = None
+
+
+def serve():
+    """Loads the plugins and takes calls until the plugins are replaced, then
+    starts again with the new ones."""
+    global pluginlib
+    import pluginlib
+    pluginlib.configure_logging('transferd')
+    plugins = load_plugins()
+    server = make_server()
+    pluginlib.log.info('Listening on %s for calls to %s.', SOCKET_PATH,
+                       ', '.join(PLUGINS))
+    children = []
+    while True:
+        conn = accept(server)
+        reap_children(children)
+        # Checked before forking, so that the plugin makes this call itself
+        # and the daemon restarts.
+        if plugins.is_stale():
+            send_status(conn, 'STALE')
+            conn.close()
+            break
+        if len(children) >= MAX_CHILDREN:
+            # Rather than waiting for a call to finish, which would hold up
+            # every other plugin call until then.
+            send_status(conn, 'BUSY')
+            conn.close()
+            continue
+        pid = os.fork()
+        if pid == 0:
+            try:
+                try:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    # Nothing forked by the call, such as the process of an
+                    # async call, may hold on to the daemon's socket.
+                    server.close()
+                    handle_call(plugins, conn)
+                except Exception, exn:
+                    pluginlib.log.error('Failed to handle a call: %s', exn)
+            finally:
+                os._exit(0)
+        conn.close()
+        children.append(pid)
+    pluginlib.log.info('Plugins have changed on disk; restarting.')
+    server.close()
+    os.execv(sys.executable, [sys.executable, DAEMON_PATH, 'run'])
+
+
+def make_server():
+    make_state_dir()
+    try:
+        os.unlink(SOCKET_PATH)
+    except OSError, exn:
+        if exn.errno != errno.ENOENT:
+            raise
+    # The calls carry xapi session handles, so only root may connect.
+    old_umask = os.umask(077)
+    try:
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(SOCKET_PATH)
+    finally:
+        os.umask(old_umask)
+    server.listen(LISTEN_BACKLOG)
+    return server
+
+
+def accept(server):
+    while True:
+        try:
+            return server.accept()[0]
+        except socket.error, exn:
+            if exn.args[0] != errno.EINTR:
+                raise
+
+
+def reap_children(children):
+    """Waits for those of the given children that have exited."""
+    while children:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError, exn:
+            if exn.errno != errno.ECHILD:
+                raise
+            del children[:]
+            return
+        if pid == 0:
+            return
+        if pid in children:
+            children.remove(pid)
+
+
+def load_plugins():
+    """
+    Imports the plugins, and returns them as a PluginSet, along with the
+    mtime of each of their files and of the modules they import.
+    """
+    plugins = {}
+    for name in PLUGINS:
+        plugins[name] = load_plugin(name, PLUGIN_DIR + name)
+    # Loading the plugins set up their loggers over our own.
+    use_logger('transferd')
+    # The calls are forked from here, so they need not import these again.
+    pluginlib.import_lazy_modules()
+
+    sources = {}
+    for module in sys.modules.values():
+        path = getattr(module, '__file__', None)
+        if path is None or not path.startswith(PLUGIN_DIR):
+            continue
+        if path.endswith('.pyc') or path.endswith('.pyo'):
+            path = path[:-1]
+        sources[path] = os.stat(path).st_mtime
+    return PluginSet(plugins, sources)
+
+
+def load_plugin(name, path):
+    # Not imp.load_source, which would leave compiled files beside the
+    # plugins, where xapi would take them for plugins too.  The module is
+    # registered under a name of its own, so that the copy plugin does not
+    # hide the standard copy module from the modules that the calls import.
+    import imp
+    module_name = MODULE_PREFIX + name
+    module = imp.new_module(module_name)
+    module.__file__ = path
+    sys.modules[module_name] = module
+    f = open(path, 'r')
+    try:
+        code = compile(f.read(), path, 'exec')
+    finally:
+        f.close()
+    exec code in module.__dict__
+    return module
+
+
+class PluginSet(object):
+    """The plugin modules by name, and the mtimes of the files they came
+    from, by path."""
+    def __init__(self, modules, sources):
+        self.modules = modules
+        self.sources = sources
+
+    def is_stale(self):
+        for path, mtime in self.sources.iteritems():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+def use_logger(name):
+    """Points the plugin modules at the given logger, which is configured
+    already."""
+    import logging
+    logger = logging.getLogger(name)
+    for module in sys.modules.values():
+        if isinstance(getattr(module, 'log', None), logging.Logger):
+            module.log = logger
+
+
+def handle_call(plugins, conn):
+    """Runs one plugin call, in the child forked for it."""
+    conn.settimeout(REPLY_TIMEOUT_SECONDS)
+    f = conn.makefile('rb')
+    try:
+        plugin, length = f.readline().split()
+        request = f.read(int(length))
+        module = plugins.modules.get(plugin)
+        if module is None:
+            send_status(conn, 'UNKNOWN')
+            return
+        # The plugin sends GO as soon as it has the OK, or has given up
+        # already and closes the socket, so this need not time out.  Back to
+        # blocking, too, before the socket becomes the call's stdout.
+        conn.settimeout(None)
+        send_status(conn, 'OK')
+        try:
+            go = f.readline()
+        except socket.error:
+            go = ''
+    finally:
+        f.close()
+    if go != 'GO\n':
+        # The plugin gave up waiting, and is making the call itself.
+        pluginlib.log.info('The %s plugin did not wait for its call.',
+                           plugin)
+        return
+    run_call(plugin, module, conn, request)
+
+
+def send_status(sock, status):
+    """Nothrow guarantee."""
+    try:
+        sock.sendall(status + '\n')
+    except socket.error:
+        pass
+
+
+def run_call(plugin, module, sock, request):
+    """
+    Makes the given plugin call as XenAPIPlugin.dispatch does for the plugin,
+    with stdout going to the given socket.  The socket is closed once the
+    call has printed its result, so that the plugin gets EOF even if the call
+    leaves a process running.
+    """
+    import XenAPIPlugin
+    use_logger(plugin)
+    sys.argv = [PLUGIN_DIR + plugin, request]
+    sys.stdout.flush()
+    os.dup2(sock.fileno(), 1)
+    sock.close()
+    try:
+        try:
+            XenAPIPlugin.dispatch(module.PLUGIN_FUNCTIONS)
+        except SystemExit:
+            pass
+    finally:
+        sys.stdout.flush()
+        null_fd = os.open('/dev/null', os.O_RDWR)
+        os.dup2(null_fd, 1)
+        os.close(null_fd)
+        # The child leaves by os._exit, so atexit handlers do not run.
+        pluginlib.detach_all_from_dom0()
+
+
+def make_state_dir():
+    if not os.path.exists(STATE_DIR):
+        try:
+            os.makedirs(STATE_DIR)
+        except OSError:
+            # Someone else created it first.
+            pass
+
+
+##### Control
+
+def read_pid():
+    """Returns the pid of the running daemon, or None."""
+    try:
+        f = open(PID_PATH, 'r')
+        try:
+            pid = int(f.read().strip())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except OSError, exn:
+        if exn.errno == errno.ESRCH:
+            return None
+    return pid
+
+
+def start():
+    pid = read_pid()
+    if pid is not None:
+        print 'transferd is already running (pid %d).' % pid
+        return
+    make_state_dir()
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        print 'transferd started.'
+        return
+    try:
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                os.chdir('/')
+                null_fd = os.open('/dev/null', os.O_RDWR)
+                for fd in [0, 1, 2]:
+                    os.dup2(null_fd, fd)
+                os.close(null_fd)
+                run()
+        except Exception, exn:
+            sys.stderr.write('Failed to start transferd: %s\n' % exn)
+    finally:
+        os._exit(0)
+
+
+def run():
+    f = open(PID_PATH, 'w')
+    try:
+        f.write('%d\n' % os.getpid())
+    finally:
+        f.close()
+    # Calls in progress carry on in their own processes when the daemon is
+    # stopped.
+    signal.signal(signal.SIGTERM, stop_serving)
+    try:
+        try:
+            serve()
+        except SystemExit:
+            pass
+        except Exception, exn:
+            if pluginlib is not None:
+                pluginlib.log.error('transferd failed: %s', exn)
+            raise
+    finally:
+        remove_state_files()
+
+
+def stop_serving(signum, frame):
+    sys.exit(0)
+
+
+def remove_state_files():
+    for path in [SOCKET_PATH, PID_PATH]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def stop():
+    pid = read_pid()
+    if pid is None:
+        print 'transferd is not running.'
+        return
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + STOP_TIMEOUT_SECONDS
+    while read_pid() == pid and time.time() < deadline:
+        time.sleep(0.1)
+    print 'transferd stopped.'
+
+
+def status():
+    pid = read_pid()
+    if pid is None:
+        print 'transferd is not running.'
+        sys.exit(3)
+    print 'transferd is running (pid %d).' % pid
+
+
+if __name__ == '__main__':
+    commands = {'start': start, 'stop': stop, 'status': status, 'run': run}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        sys.stderr.write('Usage: %s %s\n' % (sys.argv[0],
+                                            '|'.join(commands.keys())))
+        sys.exit(2)
+    commands[sys.argv[1]]()
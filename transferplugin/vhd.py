@@ -22,11 +22,14 @@ import subprocess
 from pluginlib import *
 
 
-VHD_UTIL = filter(os.path.exists, ["/usr/bin/vhd-util", "/usr/sbin/vhd-util"])[0]
+VHD_UTIL_PATHS = ["/usr/bin/vhd-util", "/usr/sbin/vhd-util"]
 SR_MOUNT = '/var/run/sr-mount'
 SR_MOUNT_VDI_PATTERN = SR_MOUNT + '/%s/%s.vhd'
 LOCAL_VDI_PATTERN = '/dev/VG_XenStorage-%s/VHD-%s'
 
+# The path to vhd-util, once vhd_util has looked for it.
+vhd_util_path = None
+
 
 # VHD SRs that are mounted at /var/run/sr-mount.
 VHD_STYLE_SR_MOUNT = 1
@@ -120,8 +123,19 @@ def make_vhd_path_local(session, vdi_rec):
                             '%s.vhd' % vdi_uuid)
 
 
+def vhd_util():
+    """Returns the path to vhd-util.  It is looked for on first use, rather
+    than on import, so that the calls that do not need it do not pay for
+    it."""
+    global vhd_util_path
+    if vhd_util_path is None:
+        vhd_util_path = filter(os.path.exists, VHD_UTIL_PATHS)[0]
+    return vhd_util_path
+
+
 def set_vhd_parent(path, parent):
-    process = subprocess.Popen([VHD_UTIL, 'modify', '-p', parent, '-n', path],
+    process = subprocess.Popen([vhd_util(), 'modify', '-p', parent, '-n',
+                                path],
                                stdout=subprocess.PIPE,
                                close_fds=True,
                                cwd='/',
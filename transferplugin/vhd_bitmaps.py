@@ -29,23 +29,28 @@ from copy import deepcopy
 
 ##### Code
 
-def get_merged_bitmap(session, leaf_vdi_ref):
+def get_merged_bitmap(session, leaf_vdi_ref, timer=None):
     """
     Returns the result of ORing all the bitmaps between
     the leaf VHD and the base VHD. This results is exposing
     the sparse version of a raw disk, and for a VHD tree removes
     the need for downloading all of the vhd chain.
+
+    If a PhaseTimer is given, the time spent fencing the SR and reading the
+    bitmaps is added to its sr_fence and bitmaps phases.
     """
+    if timer is None:
+        timer = PhaseTimer()
 
-    leaf_vdi_uuid = session.xenapi.VDI.get_uuid(leaf_vdi_ref)
-    write_sr_config(session, leaf_vdi_uuid)
+    vdi_rec = session.xenapi.VDI.get_record(leaf_vdi_ref)
+    fence = timer.time('sr_fence', fence_srs, session, [vdi_rec])
 
     try:
         result = {}
-        vdi_rec = session.xenapi.VDI.get_record(leaf_vdi_ref)
         sr_style = get_sr_style(session, vdi_rec['SR'])
-        with_vhd_files(session, sr_style, leaf_vdi_ref, vdi_rec, True,
-                       lambda paths: build_bitmap_map(paths, result))
+        timer.time('bitmaps', with_vhd_files, session, sr_style,
+                   leaf_vdi_ref, vdi_rec, True,
+                   lambda paths: build_bitmap_map(paths, result))
 
         final_bitmap = None
         for _, (vdi_uuid, bitmap) in result.iteritems():
@@ -55,33 +60,38 @@ def get_merged_bitmap(session, leaf_vdi_ref):
             else:
                 final_bitmap = or_bitmap(final_bitmap, bitmap)
     finally:
-        remove_sr_config(session, leaf_vdi_uuid)
+        unfence_srs(session, fence)
 
     return encode_bitmap(final_bitmap)
 
-def get_all_bitmaps(session, leaf_vdi_refs):
+def get_all_bitmaps(session, leaf_vdi_refs, timer=None):
     """
     Returns a dictionary of (VDI ref -> (VDI UUID, raw bitmap) for each
     VDI in a chain between one of the provided leaf_vdi_refs and a root VDI.
+
+    If a PhaseTimer is given, the time spent fencing the SRs and reading the
+    bitmaps is added to its sr_fence and bitmaps phases.
     """
-    ####### Mark the SR and cancel current storage cleanup ops #######
+    if timer is None:
+        timer = PhaseTimer()
+
     vdi_refs = list(leaf_vdi_refs) #convert dict-iterator to list
+    vdi_recs = [session.xenapi.VDI.get_record(vdi_ref) for vdi_ref in vdi_refs]
 
-    for vdi_ref in vdi_refs:
-        vdi_uuid = session.xenapi.VDI.get_uuid(vdi_ref)
-        write_sr_config(session, vdi_uuid)
+    ####### Mark the SRs and cancel current storage cleanup ops #######
+    fence = timer.time('sr_fence', fence_srs, session, vdi_recs)
 
     try:
         result = {}
-        for vdi_ref in vdi_refs:
-            vdi_rec = session.xenapi.VDI.get_record(vdi_ref)
-            sr_style = get_sr_style(session, vdi_rec['SR'])
-            with_vhd_files(session, sr_style, vdi_ref, vdi_rec, True,
-                           lambda paths: build_bitmap_map(paths, result))
+        sr_styles = {}
+        for vdi_ref, vdi_rec in zip(vdi_refs, vdi_recs):
+            if vdi_rec['SR'] not in sr_styles:
+                sr_styles[vdi_rec['SR']] = get_sr_style(session, vdi_rec['SR'])
+            timer.time('bitmaps', with_vhd_files, session,
+                       sr_styles[vdi_rec['SR']], vdi_ref, vdi_rec, True,
+                       lambda paths: build_bitmap_map(paths, result))
     finally:
-        for vdi_ref in vdi_refs:
-            vdi_uuid = session.xenapi.VDI.get_uuid(vdi_ref)
-            remove_sr_config(session, vdi_uuid)
+        unfence_srs(session, fence)
 
     return result
 
@@ -99,7 +109,7 @@ def build_bitmap_map(paths, result):
 
 
 def read_bitmap(vdi_rec, path):
-    process = subprocess.Popen([VHD_UTIL, 'read', '-B', '-n', path],
+    process = subprocess.Popen([vhd_util(), 'read', '-B', '-n', path],
                                stdout=subprocess.PIPE,
                                close_fds=True,
                                cwd='/',
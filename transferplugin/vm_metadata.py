@@ -16,13 +16,26 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-import cStringIO
 import httplib
+import socket
 import tarfile
-from xml.dom import minidom
+from xml.parsers import expat
+from xml.sax.saxutils import escape
 
 from pluginlib import *
 
+# try import ssl in python 2.7 and mute pylint
+#pylint: disable=I0011,E1101,E1123
+try:
+    import ssl
+    _ = ssl.create_default_context
+except:
+    ssl = None
+
+
+# The most metadata that fetch_vm_metadata will read into memory.
+MAX_METADATA_BYTES = 64 * 1024 * 1024
+
 
 class MetadataDownloadFailed(PluginError):
     """We failed to download the specified VM's metadata."""
@@ -42,7 +55,8 @@ class InvalidOVAXML(PluginError):
         PluginError.__init__(self, *args)
 
 def import_vm_metadata(session, tarball):
-    """Import metadata via localhost"""
+    """Import metadata via localhost.  tarball is a NewMetadataTarball, which
+    is produced as it is sent."""
 
     protocol = "http"
     host = "localhost"
@@ -53,12 +67,18 @@ def import_vm_metadata(session, tarball):
     url = ('/import_metadata?session_id=%s&task_id=%s&force=true' %
            (session.handle, task_ref))
     log.debug('Uploading metadata to %s://%s:%s%s (len %d)', protocol, host,
-              port, url, len(tarball))
+              port, url, tarball.size)
 
     try:
         conn = httplib.HTTPConnection(host, port)
         try:
-            conn.request('PUT', url, tarball)
+            conn.putrequest('PUT', url)
+            conn.putheader('Content-Length', str(tarball.size))
+            conn.endheaders()
+            try:
+                tarball.write_to(conn.send)
+            except socket.error, exn:
+                raise MetadataUploadFailed(url, str(exn))
             response = conn.getresponse()
             log.debug('Upload response is %s', response.status)
             if response.status != 200:
@@ -73,207 +93,456 @@ def import_vm_metadata(session, tarball):
         ignore_failure(session.xenapi.task.destroy, task_ref)
 
 
-def make_new_vm_metadata(vm_metadata, vdi_map, sr_uuid):
-    ova_xml = parse_ova_xml(vm_metadata)
-    try:
-        update_vdi_locations(ova_xml, vdi_map, sr_uuid)
-        return make_vm_metadata_tarball(ova_xml.toxml())
-    finally:
-        ova_xml.unlink()
-
-
-def parse_ova_xml(vm_metadata):
+def fetch_vm_metadata(protocol, host, port, path, ssl_cert=None):
     """
-    Take the given VM export tarball, extract ova.xml, and parse it.  Returns
-    a minidom document.
+    GET the given export_metadata path from the given host, and return the
+    tarball.  If ssl_cert is given, the host's certificate must match it.
     """
-    tf = tarfile.open(mode='r:', fileobj=vm_metadata)
-    try:
-        ova_xml_file = tf.extractfile('ova.xml')
-        try:
-            return minidom.parse(ova_xml_file)
-        finally:
-            ova_xml_file.close()
-    finally:
-        tf.close()
-
-
-def make_vm_metadata_tarball(ova_xml):
-    ova_xml = ova_xml.encode('UTF-8')
-    out_file = cStringIO.StringIO()
-    ova_xml_file = cStringIO.StringIO(ova_xml)
+    log.debug('Fetching metadata from %s://%s:%s%s...', protocol, host, port,
+              path.split('?')[0])
+    if protocol == 'https':
+        if ssl is not None and ssl_cert:
+            context = ssl.create_default_context(cadata=ssl_cert)
+            # The certificate is pinned, and hosts are often reached by IP
+            # address or short name, which it need not carry.
+            context.check_hostname = False
+            conn = httplib.HTTPSConnection(host, port, context=context)
+        else:
+            log.warn('Cannot check the certificate of %s.', host)
+            conn = httplib.HTTPSConnection(host, port)
+    else:
+        conn = httplib.HTTPConnection(host, port)
     try:
-        tf = tarfile.open(mode='w:', fileobj=out_file, bufsize=512)
-        try:
-            ti = tarfile.TarInfo(name='ova.xml')
-            ti.size = len(ova_xml)
-            tf.addfile(ti, fileobj=ova_xml_file)
-        finally:
-            tf.close()
-        return out_file.getvalue()
+        conn.request('GET', path)
+        response = conn.getresponse()
+        if response.status != 200:
+            raise MetadataDownloadFailed(
+                'Fetching metadata from %s failed: %s %s' %
+                (host, response.status, response.reason))
+        tarball = response.read(MAX_METADATA_BYTES + 1)
+        if len(tarball) > MAX_METADATA_BYTES:
+            raise MetadataDownloadFailed(
+                'Metadata from %s is more than %d bytes' %
+                (host, MAX_METADATA_BYTES))
     finally:
-        ova_xml_file.close()
-        out_file.close()
-
-
-def update_vdi_locations(ova_xml, vdi_map, sr_uuid):
-    array_node = get_objects_value(ova_xml)
-    for val in array_node.childNodes[0].childNodes: # Skipped array/data
-        struct = val.childNodes[0]
-        if has_member(struct, 'class', 'VDI'):
-            update_vdi_location(struct, vdi_map)
-        elif has_member(struct, 'class', 'SR'):
-            update_sr_uuid(struct, sr_uuid)
-
-
-def get_objects_value(ova_xml):
-    struct = ova_xml.childNodes[0].childNodes[0] # value/struct
-    for member in struct.childNodes: # member
-        if is_member(member, 'objects'):
-            return get_value(member)
-    raise InvalidOVAXML()
-
-
-def foreach_instance(ova_xml, cls, f):
-    array_node = get_objects_value(ova_xml)
-    for val in array_node.childNodes[0].childNodes: # Skipped array/data
-        struct = val.childNodes[0]
-        if has_member(struct, 'class', cls):
-            do_for_snapshot(struct, f)
+        conn.close()
+    log.debug('Fetching metadata done: %d bytes.', len(tarball))
+    return tarball
 
 
-def do_for_snapshot(struct, f):
-    for member in struct.childNodes:
-        if is_member(member, 'snapshot'):
-            f(get_value(member))
-            return
-
-
-def update_vdi_location(struct, vdi_map):
-    do_for_snapshot(struct, lambda v: replace_location(v, vdi_map))
-
-
-def update_sr_uuid(struct, sr_uuid):
-    do_for_snapshot(struct, lambda v: replace_uuid(v, sr_uuid))
-
-
-def replace_location(snap, vdi_map):
-    for member in snap.childNodes:
-        if is_member(member, 'location'):
-            val = get_value(member)
-            old_location = val.wholeText
-            new_location = \
-                old_location in vdi_map and \
-                    vdi_map[old_location] or \
-                    'OpaqueRef:NULL'
-            val.replaceWholeText(new_location)
-            return
-    log.warn("Failed to find location")
-    raise InvalidOVAXML()
+# The orders that get_import_instructions can give instructions in.
+IMPORT_ORDERS = ['depth', 'parallel']
 
 
-def replace_uuid(snap, uuid):
-    for member in snap.childNodes:
-        if is_member(member, 'uuid'):
-            val = get_value(member)
-            val.replaceWholeText(uuid)
-            return
-    log.warn("Failed to find uuid")
-    raise InvalidOVAXML()
-
-def get_networks(ova_xml):
-    result = []
-
-    def get_networks_(snap):
-        arr = {}
-        arr['uuid'] = get_value_from(snap, 'uuid').wholeText
-        arr['name_label'] = get_value_from(snap, 'name_label').wholeText
-        arr['name_description'] = "New network created on Import"
-        oc = {}
-        oc['created_on_import'] = "true"
-        arr['other_config'] = oc
-        arr['bridge'] = get_value_from(snap, 'bridge').wholeText
-        arr['MTU'] = get_value_from(snap, 'MTU').wholeText
-        result.append(arr)
-
-    foreach_instance(ova_xml, 'network', get_networks_)
-    return result
-
-def get_vdis(ova_xml):
+def get_import_instructions(session, ova_xml, order='depth'):
     """
-    Parse the given ova.xml, and return a dictionary from VDI location to a
-    triple of (parent, virtual_size, is_a_snapshot), for all VDIs in the XML.
+    Returns the list of instructions that tells a client how to import the
+    VDIs in the given ova.xml (an OvaXml from scan_ova_xml), bearing in mind
+    all the complexity of managing snapshots.  Creates any networks that the
+    metadata refers to but that don't exist here.
+
+    With order 'depth', each tree of VDIs is given depth first.  With order
+    'parallel', the trees are given breadth first, so that the pulls that
+    can run side by side come together, and each instruction that depends on
+    others ends with "after <i>,<j>...", the indices of the instructions
+    that must be done first.
     """
-    result = {}
-
-    def get_vdis_(snap):
-        result[get_location(snap)] = \
-            (get_parent(snap), get_virtual_size(snap),
-             get_is_a_snapshot(snap))
-
-    foreach_instance(ova_xml, 'VDI', get_vdis_)
+    prepare_networks(session, ova_xml.networks)
+    vdis = ova_xml.vdis
+    children = {}
+    roots = []
+    for (v, (parent, _, _)) in vdis.iteritems():
+        if parent is None:
+            roots.append(v)
+        else:
+            children.setdefault(parent, []).append(v)
+
+    if order == 'parallel':
+        return generate_instructions(vdis, breadth_first(roots, children),
+                                     children, True)
+    else:
+        return generate_instructions(vdis, depth_first(roots, children),
+                                     children)
+
+
+def depth_first(roots, children):
+    result = []
+    stack = roots[:]
+    stack.reverse()
+    while stack:
+        v = stack.pop()
+        result.append(v)
+        if v in children:
+            cs = children[v][:]
+            cs.reverse()
+            stack.extend(cs)
     return result
 
 
-def get_location(snap):
-    return get_value_from(snap, 'location').wholeText
+def breadth_first(roots, children):
+    result = roots[:]
+    i = 0
+    while i < len(result):
+        result.extend(children.get(result[i], []))
+        i += 1
+    return result
 
 
-def get_parent(snap):
-    struct = get_value_from(snap, 'sm_config')
-    for member in struct.childNodes:
-        if not is_member(member, 'vhd-parent'):
-            continue
-        return get_value(member).wholeText
-    return None
+def generate_instructions(vdis, ordered_vdis, children, annotate=False):
+    """
+    Returns the instructions for the given VDIs, in the given order, in which
+    each parent must come before its children.  Of each parent's children,
+    all but the last are cloned from it, and the last reuses it, and so must
+    come after the others.
+    """
+    result = []
+    # The index of the instruction that pulls each VDI.
+    pulls = {}
+
+    def add(instruction, deps):
+        if annotate and deps:
+            instruction = '%s after %s' % (instruction,
+                                           ','.join([str(d) for d in deps]))
+        result.append(instruction)
+
+    for v in ordered_vdis:
+        parent, virtual_size, is_a_snapshot = vdis[v]
+        if virtual_size % 512 != 0:
+            virtual_size = ((virtual_size + 511) >> 9) << 9
+            log.info('Rounded VDI %s up to %d', v, virtual_size)
+        pulls[v] = len(result)
+        if parent is None:
+            add("create %s %s" % (v, virtual_size), [])
+        elif children[parent][-1] == v:
+            add("reuse %s %s" % (v, parent),
+                [pulls[parent]] + [pulls[c] for c in children[parent][:-1]])
+        else:
+            add("clone %s %s" % (v, parent), [pulls[parent]])
+
+        if v in children:
+            result.append("pass")
+        else:
+            if is_a_snapshot:
+                add("snap %s" % v, [pulls[v]])
+            else:
+                add("leaf %s" % v, [pulls[v]])
+    return result
 
 
-def get_virtual_size(snap):
-    return long(get_value_from(snap, 'virtual_size').wholeText)
+def prepare_network(session, network):
+    """A method to take a network record (as parsed from VM-Metadata),
+    check if that network exists for the import session, and if it
+    doesn't, then creates a dummy network using the information
+    passed inside the network object.
+    """
+    existing_network = session.xenapi.network.get_by_name_label(network['name_label'])
+    if len(existing_network) == 0:
+        #Create a network since metadata refers to it by it's name-label
+        new_network = session.xenapi.network.create(network)
+        network_uuid = session.xenapi.network.get_uuid(new_network)
+        log.debug("New dummy network created: %s", network_uuid)
 
+def prepare_networks(session, networks):
+    #Networks in the metadata - so if not present, can be recreated
+    if len(networks) > 0:
+        for network in networks:
+            prepare_network(session, network)
 
-def get_is_a_snapshot(snap):
-    return get_bool(get_value_from(snap, 'is_a_snapshot'))
 
+class NewMetadataTarball(object):
+    """
+    Takes the given VM export tarball, and produces a new one, with the VDI
+    locations in ova.xml replaced as given by vdi_map (or with OpaqueRef:NULL
+    where they are not in it), and the uuid of the SR replaced by sr_uuid.
+
+    The new tarball is never held in memory: write_to rewrites ova.xml as it
+    writes it out.  The tar header needs the size of the new ova.xml first,
+    so that is found here by rewriting it once already, only counting the
+    bytes.  vm_metadata must be a seekable file, and must not change between
+    the two.
+    """
+    def __init__(self, vm_metadata, vdi_map, sr_uuid):
+        self.vm_metadata = vm_metadata
+        self.vdi_map = vdi_map
+        self.sr_uuid = sr_uuid
+
+        counter = ByteCounter()
+        self.rewrite(counter)
+        self.ova_xml_size = counter.count
+        self.header = self.make_header()
+
+        # As tarfile would write it: the header, ova.xml padded to a whole
+        # block, two blocks of zeros, and padding to a whole record.
+        size = len(self.header) + round_up(self.ova_xml_size,
+                                           tarfile.BLOCKSIZE)
+        self.size = round_up(size + 2 * tarfile.BLOCKSIZE, tarfile.RECORDSIZE)
+
+    def make_header(self):
+        ti = tarfile.TarInfo(name='ova.xml')
+        ti.size = self.ova_xml_size
+        return ti.tobuf()
+
+    def rewrite(self, out):
+        self.vm_metadata.seek(0)
+        stream = OvaXmlStream(out, self.vdi_map, self.sr_uuid)
+        with_ova_xml(self.vm_metadata, stream.run)
+
+    def write_to(self, write):
+        """Writes the tarball out through the given function, in pieces of up
+        to WRITE_CHUNK_SIZE bytes."""
+        out = ChunkWriter(write)
+        out.write(self.header)
+        self.rewrite(out)
+        if out.count != len(self.header) + self.ova_xml_size:
+            raise InvalidOVAXML('ova.xml changed while being rewritten')
+        out.write('\0' * (self.size - out.count))
+        out.flush()
+
+
+# The size of the pieces that NewMetadataTarball.write_to writes.
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class ChunkWriter(object):
+    """Gathers small writes into pieces of WRITE_CHUNK_SIZE bytes for the
+    given write function, counting the bytes."""
+    def __init__(self, write):
+        self.write_chunk = write
+        self.pieces = []
+        self.pending = 0
+        self.count = 0
+
+    def write(self, s):
+        self.pieces.append(s)
+        self.pending += len(s)
+        self.count += len(s)
+        if self.pending >= WRITE_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pieces:
+            self.write_chunk(''.join(self.pieces))
+            self.pieces = []
+            self.pending = 0
+
+
+class ByteCounter(object):
+    """A file that only counts the bytes written to it."""
+    def __init__(self):
+        self.count = 0
+
+    def write(self, s):
+        self.count += len(s)
+
+
+def round_up(n, block):
+    return (n + block - 1) / block * block
+
+
+def scan_ova_xml(vm_metadata):
+    """
+    Take the given VM export tarball, extract ova.xml, and read the VDIs and
+    networks from it.  Returns an OvaXml.
+    """
+    stream = OvaXmlStream()
+    with_ova_xml(vm_metadata, stream.run)
+    return OvaXml(stream.vdis, stream.networks)
 
-def get_bool(node):
-    return node.childNodes[0].wholeText == "1"
 
+def with_ova_xml(vm_metadata, f):
+    """Calls f with ova.xml from the given VM export tarball, as a file."""
+    tf = tarfile.open(mode='r:', fileobj=vm_metadata)
+    try:
+        ova_xml_file = tf.extractfile('ova.xml')
+        try:
+            return f(ova_xml_file)
+        finally:
+            ova_xml_file.close()
+    finally:
+        tf.close()
 
-def get_value_from(snap, mem):
-    for member in snap.childNodes:
-        if is_member(member, mem):
-            val = get_value(member)
-            return val
-    log.warn("Failed to find %s", mem)
-    raise InvalidOVAXML()
 
+class OvaXml(object):
+    """
+    What import needs from an ova.xml.  vdis is a dictionary from VDI location
+    to a triple of (parent, virtual_size, is_a_snapshot), for all VDIs in the
+    XML, and networks is a list of network records, ready for network.create.
+    """
+    def __init__(self, vdis, networks):
+        self.vdis = vdis
+        self.networks = networks
 
-def has_member(node, k, v):
-    if node.localName != 'struct':
-        return False
-    for member in node.childNodes:
-        if is_member(member, k, v):
-            return True
-    return False
 
+# Elements whose text is only ever whitespace between their children.
+CONTAINERS = ['struct', 'member', 'array', 'data']
 
-def is_member(node, k, v=None):
-    if node.localName != 'member':
-        return False
-    cn = node.childNodes
-    if len(cn) != 2:
-        return False
-    return (cn[0].localName == 'name' and
-            cn[0].childNodes[0].wholeText == k and
-            (v is None or
-             (cn[1].localName == 'value' and
-              cn[1].childNodes[0].wholeText == v)))
 
+class OvaXmlStream(object):
+    """
+    Reads ova.xml with expat, in one pass, collecting the VDIs and networks.
+    If out is given, the XML is written back to it as it goes, byte for byte
+    as minidom's toxml would, but with each VDI's location replaced as given
+    by vdi_map and each SR's uuid replaced by sr_uuid.
+
+    ova.xml is an XML-RPC struct, with an array of objects in its "objects"
+    member, each of them a struct of class, id and snapshot (the record
+    itself).  The class may come after the snapshot, so the output for each
+    object is held back until the end of that object.  No more than one
+    object is ever in memory.
+    """
+    def __init__(self, out=None, vdi_map=None, sr_uuid=None):
+        self.out = out
+        self.vdi_map = vdi_map or {}
+        self.sr_uuid = sr_uuid
+        self.vdis = {}
+        self.networks = []
+        # The names of the open elements, and of the open members.
+        self.elements = []
+        self.members = []
+        # The text of the <name> being read, if any.
+        self.name = None
+        # Whether the last start tag is still to be closed.
+        self.open_tag = False
+        # The object being read, if any: the depth of its <value>, its
+        # fields, from member path to a list of (piece index, text), and the
+        # output held back for it.
+        self.object_depth = None
+        self.fields = None
+        self.pieces = None
+
+    def run(self, f):
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.character_data
+        parser.CommentHandler = self.comment
+        parser.ProcessingInstructionHandler = self.processing_instruction
+        self.emit('<?xml version="1.0" ?>')
+        try:
+            parser.ParseFile(f)
+        except expat.ExpatError, exn:
+            raise InvalidOVAXML(str(exn))
 
-def get_value(member):
-    """Get bar from <member><name>foo</name><value>bar</value>"""
-    for n in member.childNodes:
-        if n.localName == 'value':
-            return n.childNodes[0]
-    raise InvalidOVAXML()
+    def emit(self, s):
+        if self.out is None:
+            return
+        if self.pieces is not None:
+            self.pieces.append(s)
+        else:
+            self.out.write(s.encode('UTF-8'))
+
+    def close_tag(self):
+        if self.open_tag:
+            self.emit('>')
+            self.open_tag = False
+
+    def start_element(self, name, attrs):
+        self.close_tag()
+        if (name == 'value' and self.pieces is None and
+            self.members == ['objects'] and self.elements[-1:] == ['data']):
+            self.object_depth = len(self.elements)
+            self.fields = {}
+            self.pieces = []
+        a_names = attrs.keys()
+        a_names.sort()
+        self.emit('<' + name +
+                  ''.join([' %s="%s"' % (a, escape_text(attrs[a]))
+                           for a in a_names]))
+        self.open_tag = True
+        self.elements.append(name)
+        if name == 'member':
+            self.members.append(None)
+        elif name == 'name':
+            self.name = []
+
+    def end_element(self, name):
+        if self.open_tag:
+            self.emit('/>')
+            self.open_tag = False
+        else:
+            self.emit('</%s>' % name)
+        self.elements.pop()
+        if name == 'member':
+            self.members.pop()
+        elif name == 'name':
+            if self.members:
+                self.members[-1] = ''.join(self.name)
+            self.name = None
+        elif name == 'value' and len(self.elements) == self.object_depth:
+            self.end_object()
+
+    def character_data(self, data):
+        self.close_tag()
+        if self.name is not None:
+            self.name.append(data)
+        elif (self.fields is not None and
+              self.elements[-1] not in CONTAINERS):
+            path = tuple(self.members[1:])
+            self.fields.setdefault(path, []).append(
+                (len(self.pieces), data))
+        self.emit(escape_text(data))
+
+    def comment(self, data):
+        self.close_tag()
+        self.emit('<!--%s-->' % data)
+
+    def processing_instruction(self, target, data):
+        self.close_tag()
+        self.emit('<?%s %s?>' % (target, data))
+
+    def field(self, *path):
+        texts = self.fields.get(path)
+        if texts is None:
+            return None
+        return ''.join([t for (_, t) in texts])
+
+    def required_field(self, *path):
+        v = self.field(*path)
+        if v is None:
+            log.warn("Failed to find %s", '/'.join(path))
+            raise InvalidOVAXML()
+        return v
+
+    def replace_field(self, path, v):
+        texts = self.fields[path]
+        self.pieces[texts[0][0]] = escape_text(v)
+        for (i, _) in texts[1:]:
+            self.pieces[i] = ''
+
+    def end_object(self):
+        cls = self.field('class')
+        if cls == 'VDI':
+            location = self.required_field('snapshot', 'location')
+            self.vdis[location] = \
+                (self.field('snapshot', 'sm_config', 'vhd-parent'),
+                 long(self.required_field('snapshot', 'virtual_size')),
+                 self.required_field('snapshot', 'is_a_snapshot') == '1')
+            if self.out is not None:
+                self.replace_field(('snapshot', 'location'),
+                                   self.vdi_map.get(location,
+                                                    'OpaqueRef:NULL'))
+        elif cls == 'SR':
+            if self.out is not None:
+                self.required_field('snapshot', 'uuid')
+                self.replace_field(('snapshot', 'uuid'), self.sr_uuid)
+        elif cls == 'network':
+            self.networks.append(
+                {'uuid': self.required_field('snapshot', 'uuid'),
+                 'name_label': self.required_field('snapshot', 'name_label'),
+                 'name_description': "New network created on Import",
+                 'other_config': {'created_on_import': "true"},
+                 'bridge': self.required_field('snapshot', 'bridge'),
+                 'MTU': self.required_field('snapshot', 'MTU')})
+
+        pieces = self.pieces
+        self.object_depth = None
+        self.fields = None
+        self.pieces = None
+        if self.out is not None:
+            self.out.write(''.join(pieces).encode('UTF-8'))
+
+
+def escape_text(data):
+    """Escapes text or an attribute value, as minidom does."""
+    return escape(data, {'"': '&quot;'})
@@ -14,7 +14,7 @@ from snapshot_utils import *
 USERNAME = "root"
 PASSWORD = "xenroot"
 
-def get_vm_copy(session, vm_uuid, src_host, dst_host_ref, local_sr_uuid, op="get_vm"):
+def get_vm_copy(session, vm_uuid, src_host, dst_host_ref, local_sr_uuid, op="get_vm", extra_args={}):
     """A Utility method for calling the XAPI plugin copy to move a VM between hosts
     The 'get_vm' plugin call is made against the destination host.
     The source host is the 'remote' host.
@@ -31,6 +31,7 @@ def get_vm_copy(session, vm_uuid, src_host, dst_host_ref, local_sr_uuid, op="get
             'remote_password': PASSWORD,
             remote_vm_label: vm_uuid,
             'local_sr_uuid': local_sr_uuid}
+    args.update(extra_args)
 
     session.xenapi.host.call_plugin(dst_host_ref, 'copy', op, args)
             
@@ -55,6 +56,7 @@ class HostToHostPull(unittest.TestCase):
     DST_HOST = "sunburn"
     TEMPLATE = "Demo Linux VM"
     OPERATION = "get_vm"
+    EXTRA_ARGS = {}
     
     def testBasic(self):
         """A test that simply calls the copy plugin to initiate a transfer"""
@@ -67,8 +69,20 @@ class HostToHostPull(unittest.TestCase):
         dst_host, local_session = get_remote_host(self.DST_HOST)
         local_sr_uuid = get_local_sr_uuid(local_session)
         
-        get_vm_copy(remote_session, vm_uuid, self.SRC_HOST, dst_host, local_sr_uuid, self.OPERATION)
+        get_vm_copy(remote_session, vm_uuid, self.SRC_HOST, dst_host, local_sr_uuid, self.OPERATION, self.EXTRA_ARGS)
         
     
 class HostToHostTreePull(HostToHostPull):
     OPERATION = "get_vm_forest"
+
+class HostToHostParallelTreePull(HostToHostTreePull):
+    EXTRA_ARGS = {'parallel_pulls': '4'}
+
+class HostToHostSinglePullerTreePull(HostToHostTreePull):
+    EXTRA_ARGS = {'parallel_pulls': '14', 'max_pullers': '1'}
+
+class HostToHostResumableTreePull(HostToHostTreePull):
+    EXTRA_ARGS = {'resumable': 'true'}
+
+class HostToHostIncrementalTreePull(HostToHostTreePull):
+    EXTRA_ARGS = {'incremental': 'true'}
@@ -95,6 +95,86 @@ class ExposeConfigurationTest(unittest.TestCase):
 class ExposeConfigurationTestRemoveTVMTemplate(ExposeConfigurationTest):
     REMOVE_TEMPLATE = True
 
+class ExposePlacementTest(unittest.TestCase):
+    def testExposeWithSRMasterPlacement(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        transferclient.expose(hostname, vdi_uuid=vdi, network_uuid=network, transfer_mode='http', placement='sr_master')
+        self.assertEqual('exposed', transferclient.get_record(hostname, vdi_uuid=vdi)['status'])
+        clean_up()
+
+    def testExposeRaisesArgumentErrorForUnknownPlacement(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        moreasserts.assertRaisesXenapiFailure(self, 'ArgumentError', transferclient.expose, hostname,
+                                              vdi_uuid=vdi, network_uuid=network, transfer_mode='http', placement='random')
+        clean_up()
+
+class ExposeTimingsTest(unittest.TestCase):
+    def testExposeRecordsPhaseTimings(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        record_handle = transferclient.expose(hostname, vdi_uuid=vdi, network_uuid=network, transfer_mode='http')
+        timings = transferclient.get_expose_timings(hostname, record_handle=record_handle)
+        self.assertEqual(record_handle, timings['record_handle'])
+        for phase in ['admission', 'template_check', 'clone', 'vif_create', 'vbd_create', 'config_write',
+                      'start_on', 'wait_ip', 'wait_ready', 'total']:
+            self.assert_(float(timings[phase]) >= 0)
+        self.assert_(float(timings['total']) >= float(timings['start_on']))
+        clean_up()
+
+class ExposeAsyncTest(unittest.TestCase):
+    def testExposeAsyncPutsRecordHandleInTaskResult(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        task = transferclient.expose_async(hostname, vdi_uuid=vdi, network_uuid=network, transfer_mode='http')
+        status, record_handle, progress = transferclient.wait_for_task(hostname, task)
+        self.assertEqual('success', status)
+        self.assertEqual(1.0, progress)
+        self.assertEqual('exposed', transferclient.get_record(hostname, record_handle=record_handle)['status'])
+        clean_up()
+
+    def testExposeAsyncFailsTaskForUnknownPlacement(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        task = transferclient.expose_async(hostname, vdi_uuid=vdi, network_uuid=network, transfer_mode='http', placement='random')
+        status, _, _ = transferclient.wait_for_task(hostname, task)
+        self.assertEqual('failure', status)
+        clean_up()
+
+class ExposeAdmissionTest(unittest.TestCase):
+    def tearDown(self):
+        transferclient.set_host_other_config(testsetup.HOST, 'transfervm_max_boots', None)
+
+    def testExposesBeyondMaxBootsAreQueued(self):
+        hostname, network, firstvdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        secondvdi = transferclient.create_vdi(hostname, 'Test VDI', 10*M)
+        transferclient.set_host_other_config(hostname, 'transfervm_max_boots', '1')
+
+        tasks = [transferclient.expose_async(hostname, vdi_uuid=vdi, network_uuid=network, transfer_mode='http')
+                 for vdi in [firstvdi, secondvdi]]
+        statuses = []
+        record = {'status': 'unused'}
+        while record['status'] != 'exposed':
+            record = transferclient.get_record(hostname, vdi_uuid=secondvdi)
+            statuses.append((record['status'], record.get('queue_position')))
+            time.sleep(0.5)
+        self.assert_(('queued', '1') in statuses, statuses)
+
+        for task in tasks:
+            status, _, _ = transferclient.wait_for_task(hostname, task)
+            self.assertEqual('success', status)
+        clean_up()
+
+    def testAdmissionTimeoutFailsExpose(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        transferclient.set_host_other_config(hostname, 'transfervm_max_running', '1')
+        transferclient.set_host_other_config(hostname, 'transfervm_admission_timeout', '5')
+        try:
+            transferclient.expose(hostname, vdi_uuid=vdi, network_uuid=network, transfer_mode='http')
+            othervdi = transferclient.create_vdi(hostname, 'Test VDI', 10*M)
+            moreasserts.assertRaisesXenapiFailure(self, 'AdmissionTimeout', transferclient.expose, hostname,
+                                                  vdi_uuid=othervdi, network_uuid=network, transfer_mode='http')
+        finally:
+            transferclient.set_host_other_config(hostname, 'transfervm_max_running', None)
+            transferclient.set_host_other_config(hostname, 'transfervm_admission_timeout', None)
+        clean_up()
+
 class ExposeConcurrencyTest(unittest.TestCase):
     def testExposeWhileHammeringCleanup(self):
         hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
@@ -129,8 +209,8 @@ class ExposeConcurrencyTest(unittest.TestCase):
         asyncexpose.start()
 
         record = {'status': 'unused'}
-        while record['status'] == 'unused':
-            logging.debug('VDI status still unused, getting record')
+        while record['status'] in ['unused', 'queued', 'starting']:
+            logging.debug('VDI status still %s, getting record', record['status'])
             record = transferclient.get_record(hostname, vdi_uuid=vdi)
 
         moreasserts.assertVdiIsZeroUsingHttpGet(self, record, 10)
@@ -121,6 +121,34 @@ class GetRecordTest(unittest.TestCase):
         self.assertVdiStatus(record, vdi, 'exposed')
         clean_up()
 
+    def testGetRecordsReturnsOneRecordPerHandleInOrder(self):
+        hostname, network, vdi1 = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        vdi2 = transferclient.create_vdi(hostname, 'Second Test VDI', 12 * 1024 * 1024)
+        handle1 = transferclient.expose(hostname, vdi_uuid=vdi1, network_uuid=network, transfer_mode='http')
+        handle2 = transferclient.expose(hostname, vdi_uuid=vdi2, network_uuid=network, transfer_mode='iscsi')
+        records = transferclient.get_records(hostname, record_handles='%s,%s' % (handle2, handle1))
+        self.assertEqual(2, len(records))
+        self.assertEqual(handle2, records[0]['record_handle'])
+        self.assertEqual(handle1, records[1]['record_handle'])
+        self.assertVdiStatus(records[0], vdi2, 'exposed')
+        self.assertVdiStatus(records[1], vdi1, 'exposed')
+        self.assertEqual(records[1], transferclient.get_record(hostname, record_handle=handle1))
+        clean_up()
+
+    def testGetRecordsWithoutWaitingReturnsReadyRecords(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        handle = transferclient.expose(hostname, vdi_uuid=vdi, network_uuid=network, transfer_mode='http')
+        records = transferclient.get_records(hostname, record_handles=handle, wait='false')
+        self.assertStandardFields(records[0])
+        self.assertVdiStatus(records[0], vdi, 'exposed')
+        clean_up()
+
+    def testGetRecordsRaisesArgumentErrorForUnknownHandle(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        moreasserts.assertRaisesXenapiFailure(self, 'ArgumentError', transferclient.get_records,
+                                              hostname, record_handles=vdi)
+        clean_up()
+
 
 
 
@@ -0,0 +1,130 @@
+"""Tests of the import instructions that vm_metadata gives for a forest of
+VDIs, and of the copy plugin's reading of them.  These need no host."""
+
+import unittest
+
+import plugins
+import vm_metadata
+
+copy = plugins.load_plugin('copy')
+
+
+def instructions_for(vdis, order):
+    # With no networks, get_import_instructions makes no XenAPI calls.
+    return vm_metadata.get_import_instructions(
+        None, vm_metadata.OvaXml(vdis, []), order)
+
+def strip_after(instruction):
+    """Returns the instruction without its "after <i>,<j>..." and the
+    indices in it."""
+    words = instruction.split(' ')
+    if len(words) > 2 and words[-2] == 'after':
+        return ' '.join(words[:-2]), [int(i) for i in words[-1].split(',')]
+    return instruction, []
+
+
+# In CHAIN, a is a root, b a snapshot of it and c a child of b.  In FOREST, b
+# has two children, c and d, and e is a root of its own.
+CHAIN = {'a': (None, 1000, False),
+         'b': ('a', 1024, True),
+         'c': ('b', 1024, False)}
+FOREST = {'a': (None, 1024, False),
+          'b': ('a', 1024, True),
+          'c': ('b', 1024, False),
+          'd': ('b', 1024, False),
+          'e': (None, 2048, False)}
+
+
+class GenerateInstructionsTest(unittest.TestCase):
+
+    def testDepthOrderOfAChain(self):
+        self.assertEqual(['create a 1024', 'pass',
+                          'reuse b a', 'pass',
+                          'reuse c b', 'leaf c'],
+                         instructions_for(CHAIN, 'depth'))
+
+    def testParallelOrderOfAChainIsAnnotated(self):
+        self.assertEqual(['create a 1024', 'pass',
+                          'reuse b a after 0', 'pass',
+                          'reuse c b after 2', 'leaf c after 4'],
+                         instructions_for(CHAIN, 'parallel'))
+
+    def testParallelOrderHasTheSameInstructions(self):
+        depth = instructions_for(FOREST, 'depth')
+        parallel = [strip_after(i)[0] for i in instructions_for(FOREST, 'parallel')]
+        depth.sort()
+        parallel.sort()
+        self.assertEqual(depth, parallel)
+
+    def testParallelOrderCreatesEveryRootFirst(self):
+        parallel = instructions_for(FOREST, 'parallel')
+        kinds = [i.split(' ')[0] for i in parallel if i != 'pass']
+        self.assertEqual(['create', 'create'], kinds[:2])
+
+    def testAfterNamesTheParentAndItsOtherChildren(self):
+        parallel = instructions_for(FOREST, 'parallel')
+        pulls = {}
+        for index, instruction in zip(range(len(parallel)), parallel):
+            words, after = strip_after(instruction)
+            words = words.split(' ')
+            for i in after:
+                self.assert_(i < index, instruction)
+            if words[0] == 'create':
+                self.assertEqual([], after)
+            elif words[0] == 'clone':
+                self.assertEqual([pulls[words[2]]], after)
+            elif words[0] == 'reuse':
+                siblings = [pulls[v] for v, (parent, _, _) in FOREST.items()
+                            if parent == words[2] and v != words[1]]
+                siblings.sort()
+                self.assertEqual([pulls[words[2]]] + siblings, after)
+            elif words[0] in ['snap', 'leaf']:
+                self.assertEqual([pulls[words[1]]], after)
+            if words[0] in ['create', 'clone', 'reuse']:
+                pulls[words[1]] = index
+
+
+class ParseImportStepsTest(unittest.TestCase):
+
+    def testDependenciesMatchTheAnnotations(self):
+        parallel = instructions_for(FOREST, 'parallel')
+        for step in copy.parse_import_steps(parallel):
+            _, after = strip_after(step.instruction)
+            after.sort()
+            deps = [s.index for s, _ in step.deps]
+            deps.sort()
+            self.assertEqual(after, deps, step.instruction)
+
+    def testAnnotationsDoNotChangeTheSteps(self):
+        parallel = instructions_for(FOREST, 'parallel')
+        plain = [strip_after(i)[0] for i in parallel]
+        for annotated, stripped in zip(copy.parse_import_steps(parallel),
+                                       copy.parse_import_steps(plain)):
+            self.assertEqual(
+                (annotated.index, annotated.kind, annotated.vdi_uuid, annotated.arg),
+                (stripped.index, stripped.kind, stripped.vdi_uuid, stripped.arg))
+            self.assertEqual([(s.index, state) for s, state in annotated.deps],
+                             [(s.index, state) for s, state in stripped.deps])
+
+    def testReuseWaitsForTheOtherClonesToBePulled(self):
+        steps = copy.parse_import_steps(['create a 1024', 'pass',
+                                         'clone b a', 'leaf b',
+                                         'reuse c a', 'leaf c'])
+        reuse = steps[3]
+        self.assertEqual('reuse', reuse.kind)
+        self.assertEqual([(0, copy.STEP_DONE), (2, copy.STEP_DONE)],
+                         [(s.index, state) for s, state in reuse.deps])
+
+    def testPassIsSkipped(self):
+        steps = copy.parse_import_steps(instructions_for(CHAIN, 'depth'))
+        self.assertEqual(['create', 'reuse', 'reuse', 'leaf'],
+                         [s.kind for s in steps])
+
+    def testReferenceBeforeCreateIsRejected(self):
+        self.assertRaises(copy.InvalidInstructions, copy.parse_import_steps,
+                          ['clone b a', 'leaf b'])
+
+    def testUnknownInstructionIsRejected(self):
+        self.assertRaises(copy.InvalidInstructions, copy.parse_import_steps,
+                          ['create a 1024', 'frob a'])
+
@@ -0,0 +1,342 @@
+"""Tests of the copy plugin's running of import instructions, its journal
+and its reuse of local copies, against a fake of the XenAPI calls that they
+make.  The pulls only record which remote VDIs were written into which local
+ones.  These need no host."""
+
+import unittest
+
+import plugins
+import XenAPI
+
+copy = plugins.load_plugin('copy')
+
+
+SR_UUID = 'local-sr'
+SR_REF = 'OpaqueRef:sr'
+REMOTE_VM_UUIDS = ['vm']
+
+
+class FakeVDI(object):
+    """The VDI class, where the contents of each VDI are the set of remote
+    VDIs that have been pulled into it or the VDIs it was cloned from."""
+
+    def __init__(self):
+        self.records = {}
+        self.count = 0
+
+    def new(self, sr_ref, contents, is_a_snapshot):
+        self.count += 1
+        ref = 'OpaqueRef:vdi%d' % self.count
+        self.records[ref] = {'uuid': 'local%d' % self.count,
+                             'SR': sr_ref,
+                             'contents': set(contents),
+                             'is_a_snapshot': is_a_snapshot,
+                             'other_config': {}}
+        return ref
+
+    def rec(self, ref):
+        if ref not in self.records:
+            raise XenAPI.Failure(['HANDLE_INVALID', 'VDI', ref])
+        return self.records[ref]
+
+    def create(self, rec):
+        return self.new(rec['SR'], [], False)
+
+    def clone(self, ref):
+        return self.new(self.rec(ref)['SR'], self.rec(ref)['contents'], False)
+
+    def snapshot(self, ref):
+        return self.new(self.rec(ref)['SR'], self.rec(ref)['contents'], True)
+
+    def destroy(self, ref):
+        self.rec(ref)
+        del self.records[ref]
+
+    def get_by_uuid(self, uuid):
+        for ref, rec in self.records.iteritems():
+            if rec['uuid'] == uuid:
+                return ref
+        raise XenAPI.Failure(['UUID_INVALID', 'VDI', uuid])
+
+    def get_uuid(self, ref):
+        return self.rec(ref)['uuid']
+
+    def get_SR(self, ref):
+        return self.rec(ref)['SR']
+
+    def set_name_label(self, ref, name_label):
+        self.rec(ref)
+
+    def get_other_config(self, ref):
+        return dict(self.rec(ref)['other_config'])
+
+    def add_to_other_config(self, ref, k, v):
+        other_config = self.rec(ref)['other_config']
+        if k in other_config:
+            raise XenAPI.Failure(['MAP_DUPLICATE_KEY', 'VDI', 'other_config',
+                                  ref, k])
+        other_config[k] = v
+
+    def remove_from_other_config(self, ref, k):
+        other_config = self.rec(ref)['other_config']
+        if k in other_config:
+            del other_config[k]
+
+    def get_all_records_where(self, expr):
+        # Only find_local_copies calls this, for the snapshots in SR_REF.
+        result = {}
+        for ref, rec in self.records.iteritems():
+            if rec['SR'] == SR_REF and rec['is_a_snapshot']:
+                result[ref] = {'uuid': rec['uuid'],
+                               'other_config': dict(rec['other_config'])}
+        return result
+
+
+class FakeSR(object):
+
+    def __init__(self):
+        self.other_config = {}
+
+    def get_by_uuid(self, uuid):
+        if uuid != SR_UUID:
+            raise XenAPI.Failure(['UUID_INVALID', 'SR', uuid])
+        return SR_REF
+
+    def scan(self, ref):
+        pass
+
+    def get_other_config(self, ref):
+        return dict(self.other_config)
+
+    def add_to_other_config(self, ref, k, v):
+        if k in self.other_config:
+            raise XenAPI.Failure(['MAP_DUPLICATE_KEY', 'SR', 'other_config',
+                                  ref, k])
+        self.other_config[k] = v
+
+    def remove_from_other_config(self, ref, k):
+        if k in self.other_config:
+            del self.other_config[k]
+
+
+class FakeXenAPI(object):
+
+    def __init__(self):
+        self.VDI = FakeVDI()
+        self.SR = FakeSR()
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.xenapi = FakeXenAPI()
+
+
+class PullFailed(Exception):
+    pass
+
+
+def expose_records(remote_vdi_uuids):
+    record = {}
+    for v in remote_vdi_uuids:
+        record['url_path_%s' % v] = '/%s' % v
+        record['url_full_%s' % v] = 'http://remote/%s' % v
+    return {'remote': record}
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.batches = []
+        self.failing = []
+        self.old_complete_pulls = copy.complete_pulls
+        self.old_session_for_thread = copy.session_for_thread
+        copy.complete_pulls = self.complete_pulls
+        copy.session_for_thread = lambda session: session
+
+    def tearDown(self):
+        copy.complete_pulls = self.old_complete_pulls
+        copy.session_for_thread = self.old_session_for_thread
+
+    def complete_pulls(self, session, pulls):
+        batch = []
+        for dest_uuid, (url, _) in pulls:
+            remote_uuid = url.split('/')[-1][:-len('.vhd')]
+            ref = session.xenapi.VDI.get_by_uuid(dest_uuid)
+            session.xenapi.VDI.rec(ref)['contents'].add(remote_uuid)
+            batch.append(remote_uuid)
+        batch.sort()
+        self.batches.append(batch)
+        for remote_uuid in batch:
+            if remote_uuid in self.failing:
+                raise PullFailed(remote_uuid)
+
+    def execute(self, instructions, remote_vdi_uuids, vdi_map, journal=None,
+                incremental=False):
+        copy.execute_instructions(self.session, SR_UUID, instructions,
+                                  expose_records(remote_vdi_uuids), vdi_map,
+                                  parallel_pulls=4, max_pullers=4,
+                                  incremental=incremental, journal=journal)
+
+    def journal(self):
+        return copy.ImportJournal(self.session, SR_UUID, REMOTE_VM_UUIDS)
+
+    def contents(self, local_uuid):
+        vdis = self.session.xenapi.VDI
+        result = list(vdis.rec(vdis.get_by_uuid(local_uuid))['contents'])
+        result.sort()
+        return result
+
+    def local_uuids(self):
+        result = [rec['uuid']
+                  for rec in self.session.xenapi.VDI.records.values()]
+        result.sort()
+        return result
+
+
+# a has two children: b, which is cloned from it, and c, which reuses it.
+CLONE_AND_REUSE = ['create a 1024', 'pass',
+                   'clone b a after 0', 'leaf b after 2',
+                   'reuse c a after 0,2', 'leaf c after 4']
+
+
+class ImportSchedulerTest(ImportTestCase):
+
+    def testReuseIsNotPulledWithTheOtherClones(self):
+        vdi_map = {}
+        self.execute(CLONE_AND_REUSE, 'abc', vdi_map)
+        self.assertEqual([['a'], ['b'], ['c']], self.batches)
+        self.assertEqual(['a', 'b'], self.contents(vdi_map['b']))
+        self.assertEqual(['a', 'c'], self.contents(vdi_map['c']))
+
+    def testFailedCloneLeavesItsParentIntactForTheResume(self):
+        journal = self.journal()
+        journal.start('metadata')
+        self.failing = ['b']
+        self.assertRaises(PullFailed, self.execute, CLONE_AND_REUSE, 'abc',
+                          {}, journal)
+
+        self.failing = []
+        journal = self.journal()
+        journal.load()
+        vdi_map = dict(journal.vdi_map)
+        self.execute(CLONE_AND_REUSE, 'abc', vdi_map, journal)
+        self.assertEqual(['a', 'b'], self.contents(vdi_map['b']))
+        self.assertEqual(['a', 'c'], self.contents(vdi_map['c']))
+        # Only the two leaves are left.
+        leaves = [vdi_map['b'], vdi_map['c']]
+        leaves.sort()
+        self.assertEqual(leaves, self.local_uuids())
+
+
+class ImportJournalTest(ImportTestCase):
+
+    def journal_keys(self):
+        result = [k for k in self.session.xenapi.SR.other_config.keys()
+                  if k.startswith(copy.IMPORT_JOURNAL_KEY_PREFIX)]
+        result.sort()
+        return result
+
+    def testEachStepAddsOneKeyWithItsChanges(self):
+        journal = self.journal()
+        journal.start('metadata')
+        key = journal.key
+        self.execute(CLONE_AND_REUSE, 'abc', {}, journal)
+        other_config = self.session.xenapi.SR.other_config
+        self.assertEqual('metadata metadata', other_config[key])
+        self.assertEqual([key] + ['%s/%d' % (key, n) for n in range(5)],
+                         self.journal_keys())
+        # The reuse maps c to a's VDI, and drops a.
+        reuse = other_config['%s/3' % key].split('\n')
+        self.assertEqual('done 4 reuse c a after 0,2', reuse[0])
+        self.assertEqual(['map c %s' % journal.vdi_map['c'], 'unmap a'],
+                         reuse[1:])
+
+    def testLoadReplaysTheSteps(self):
+        journal = self.journal()
+        journal.start('metadata')
+        vdi_map = {}
+        self.execute(CLONE_AND_REUSE, 'abc', vdi_map, journal)
+        loaded = self.journal()
+        loaded.load()
+        self.assertEqual('metadata', loaded.metadata_vdi_uuid)
+        self.assertEqual(vdi_map, loaded.vdi_map)
+        done = loaded.done.keys()
+        done.sort()
+        self.assertEqual([0, 2, 3, 4, 5], done)
+
+    def testLoadReadsAJournalKeptUnderOneKey(self):
+        key = self.journal().key
+        self.session.xenapi.SR.other_config[key] = \
+            'metadata m\ndone 0 create a 1024\nmap a local1'
+        journal = self.journal()
+        journal.load()
+        self.assertEqual('m', journal.metadata_vdi_uuid)
+        self.assertEqual({0: 'create a 1024'}, journal.done)
+        self.assertEqual({'a': 'local1'}, journal.vdi_map)
+
+    def testDeleteRemovesEveryKey(self):
+        journal = self.journal()
+        journal.start('metadata')
+        self.execute(CLONE_AND_REUSE, 'abc', {}, journal)
+        journal.delete()
+        self.assertEqual([], self.journal_keys())
+
+    def testStartClearsStepsLeftByAnInterruptedDelete(self):
+        key = self.journal().key
+        self.session.xenapi.SR.other_config['%s/0' % key] = \
+            'done 0 create a 1024\nmap a local1'
+        journal = self.journal()
+        journal.start('metadata')
+        self.assertEqual([key], self.journal_keys())
+        loaded = self.journal()
+        loaded.load()
+        self.assertEqual({}, loaded.done)
+
+
+# p is the hidden parent of the VM's disk l and of its snapshot s.
+SNAPSHOT = ['create p 1024', 'pass',
+            'clone s p', 'snap s',
+            'reuse l p', 'leaf l']
+
+
+class LocalCopiesTest(ImportTestCase):
+
+    def import_again(self, instructions, remote_vdi_uuids):
+        self.batches = []
+        self.execute(instructions, remote_vdi_uuids, {}, incremental=True)
+
+    def testSnapshotsAreTaggedWithTheirSource(self):
+        vdi_map = {}
+        self.execute(SNAPSHOT, ['p', 's', 'l'], vdi_map, incremental=True)
+        s_ref = self.session.xenapi.VDI.get_by_uuid(vdi_map['s'])
+        self.assertEqual({'s': s_ref},
+                         copy.find_local_copies(self.session, SR_UUID))
+
+    def testSnapshotStandsInForItsParent(self):
+        self.execute(SNAPSHOT, ['p', 's', 'l'], {}, incremental=True)
+        # A second snapshot, s2, makes the old leaf l a hidden parent p2.
+        self.import_again(['create p 1024', 'pass',
+                           'clone s p', 'snap s',
+                           'reuse p2 p', 'pass',
+                           'clone s2 p2', 'snap s2',
+                           'reuse l p2', 'leaf l'],
+                          ['p', 's', 'p2', 's2', 'l'])
+        self.assertEqual([['p2'], ['s2'], ['l']], self.batches)
+
+    def testParentIsPulledOnceItsSnapshotIsGone(self):
+        self.execute(SNAPSHOT, ['p', 's', 'l'], {}, incremental=True)
+        # s has been deleted, and l coalesced into p, which kept its UUID
+        # but not its contents.  A new snapshot s3 was then taken.
+        self.import_again(['create p 1024', 'pass',
+                           'clone s3 p', 'snap s3',
+                           'reuse l p', 'leaf l'],
+                          ['p', 's3', 'l'])
+        self.assertEqual([['p'], ['s3'], ['l']], self.batches)
+
+    def testWithoutIncrementalEverythingIsPulled(self):
+        self.execute(SNAPSHOT, ['p', 's', 'l'], {}, incremental=True)
+        self.batches = []
+        self.execute(SNAPSHOT, ['p', 's', 'l'], {})
+        self.assertEqual([['p'], ['s'], ['l']], self.batches)
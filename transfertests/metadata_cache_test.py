@@ -0,0 +1,87 @@
+"""Tests of the dom0 cache of VM metadata in metadata_cache.  These need no
+host."""
+
+import cStringIO
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import plugins
+import metadata_cache
+import vm_metadata
+import vm_metadata_test
+
+
+VDI_UUID = 'metadata-vdi'
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old_cache_dir = metadata_cache.CACHE_DIR
+        self.cache_dir = tempfile.mkdtemp()
+        metadata_cache.CACHE_DIR = self.cache_dir + '/'
+
+    def tearDown(self):
+        metadata_cache.CACHE_DIR = self.old_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def store(self):
+        tarball = vm_metadata_test.tarball(vm_metadata_test.OVA_XML)
+        return metadata_cache.store(VDI_UUID, cStringIO.StringIO(tarball))
+
+    def age(self, name, seconds):
+        path = self.cache_dir + '/' + name
+        then = time.time() - seconds
+        os.utime(path, (then, then))
+
+    def testLookupFindsWhatWasStored(self):
+        stored = self.store()
+        entry = metadata_cache.lookup(VDI_UUID)
+        self.assertEqual(stored.content_hash, entry.content_hash)
+        self.assertEqual(['loc-a', 'loc-b', 'loc-c'], sorted(entry.ova_xml.vdis.keys()))
+        self.assertEqual(1, len(entry.ova_xml.networks))
+
+    def testCachedTarballHoldsOvaXml(self):
+        self.store()
+        f = metadata_cache.lookup(VDI_UUID).open()
+        try:
+            ova = vm_metadata.scan_ova_xml(f)
+        finally:
+            f.close()
+        self.assertEqual(['loc-a', 'loc-b', 'loc-c'], sorted(ova.vdis.keys()))
+
+    def testLookupOfUnknownVdiFindsNothing(self):
+        self.assertEqual(None, metadata_cache.lookup(VDI_UUID))
+
+    def testInvalidateDropsTheEntry(self):
+        self.store()
+        metadata_cache.invalidate(VDI_UUID)
+        self.assertEqual(None, metadata_cache.lookup(VDI_UUID))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def testEntriesExpire(self):
+        old_ttl = metadata_cache.TTL_SECONDS
+        metadata_cache.TTL_SECONDS = 0
+        try:
+            self.store()
+            time.sleep(0.1)
+            self.assertEqual(None, metadata_cache.lookup(VDI_UUID))
+        finally:
+            metadata_cache.TTL_SECONDS = old_ttl
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def testReapRemovesTarballsWithoutInfo(self):
+        entry = self.store()
+        os.unlink(metadata_cache.info_path(VDI_UUID))
+        name = os.path.basename(entry.tarball_path())
+        self.age(name, metadata_cache.TTL_SECONDS + 1)
+        metadata_cache.reap()
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def testReapKeepsFreshEntries(self):
+        self.store()
+        metadata_cache.reap()
+        self.assertNotEqual(None, metadata_cache.lookup(VDI_UUID))
@@ -0,0 +1,29 @@
+"""Gives the tests that need no host the plugin modules from this tree.
+
+The plugins' own imports must be importable too: XenAPI is here already, and
+XenAPIPlugin is in /etc/xapi.d/plugins in dom0."""
+
+import os
+import sys
+
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'transferplugin')
+
+# Appended rather than inserted, so that the modules here (vhd, for one) are
+# not hidden by the plugins' own.
+for path in [PLUGIN_DIR, '/etc/xapi.d/plugins']:
+    if path not in sys.path:
+        sys.path.append(path)
+
+# The plugin modules take pluginlib's logger when they are imported, so it
+# must be set up first.
+import pluginlib
+pluginlib.configure_logging('transfertests')
+
+
+def load_plugin(name):
+    """Returns the given plugin, such as copy, loaded as transferd loads it,
+    so that it does not hide the standard module of the same name."""
+    import transferd
+    return transferd.load_plugin(name, os.path.join(PLUGIN_DIR, name))
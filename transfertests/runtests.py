@@ -11,7 +11,7 @@ import testsetup
 import xmltestoutput
 
 
-MODULES = ['expose_test', 'timeout_test', 'manualnetwork_test', 'bits_test', 'http_test', 'unexpose_test', 'getrecord_test', 'expose_failure_test', 'vhd_tests', 'copy_plugin']
+MODULES = ['expose_test', 'timeout_test', 'manualnetwork_test', 'bits_test', 'http_test', 'unexpose_test', 'getrecord_test', 'expose_failure_test', 'vhd_tests', 'copy_plugin', 'transferd_test', 'transferd_protocol_test', 'vm_metadata_test', 'import_instructions_test', 'import_scheduler_test', 'metadata_cache_test']
 
 def load_tests(opts, args):
     suite = unittest.TestSuite()
@@ -58,6 +58,18 @@ def remove_tvm_template(hostname):
     target_commands = ('xe template-list other-config:transfervm=true --minimal | xargs -d, -Ixx xe template-uninstall template-uuid=xx --force')
     call_to_stderr(['ssh', 'root@' + hostname, target_commands])
 
+TRANSFERD = 'python /etc/xapi.d/plugins/transferd.py'
+
+def start_transferd(hostname):
+    call_to_stderr(['ssh', 'root@' + hostname, TRANSFERD + ' start'])
+
+def stop_transferd(hostname):
+    call_to_stderr(['ssh', 'root@' + hostname, TRANSFERD + ' stop'])
+
+def transferd_is_running(hostname):
+    return subprocess.call(['ssh', 'root@' + hostname, TRANSFERD + ' status'],
+                           stdout=sys.stderr) == 0
+
 # These static variables are a hack to speed up tests:
 # The XenServer host is only wiped of all VMs and VDIs when
 # a different number of VM templates or NO VDIs are requested,
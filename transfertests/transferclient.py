@@ -91,25 +91,64 @@ def call_method_and_expect_OK(session, host, method, args):
 def expose(hostname, **args):
     return call_method(hostname, 'expose', args)
 
+def expose_async(hostname, **args):
+    return call_method(hostname, 'expose_async', args)
+
+@xenapi_session
+def wait_for_task(session, host, task_ref):
+    """Waits for the given task to finish, and returns its status, result and
+    progress."""
+    while session.xenapi.task.get_status(task_ref) == 'pending':
+        time.sleep(1)
+    return (session.xenapi.task.get_status(task_ref),
+            session.xenapi.task.get_result(task_ref),
+            session.xenapi.task.get_progress(task_ref))
+
 def unexpose(hostname, **args):
     return call_method_and_expect_OK(hostname, 'unexpose', args)
 
+@xenapi_session
+def set_host_other_config(session, host, key, value):
+    """Sets the given key in the host's other_config, or removes it if
+    value is None."""
+    if key in session.xenapi.host.get_other_config(host):
+        session.xenapi.host.remove_from_other_config(host, key)
+    if value is not None:
+        session.xenapi.host.add_to_other_config(host, key, value)
+
 @xenapi_session
 def get_record(session, host, **args):
     strrecord = session.xenapi.host.call_plugin(host, 'transfer', 'get_record', args)
     logging.debug('Got record %r' % strrecord)
     return record_to_dict(strrecord)
 
+@xenapi_session
+def get_records(session, host, **args):
+    strrecords = session.xenapi.host.call_plugin(host, 'transfer', 'get_records', args)
+    logging.debug('Got records %r' % strrecords)
+    return records_to_dicts(strrecords)
+
+@xenapi_session
+def get_expose_timings(session, host, **args):
+    strrecord = session.xenapi.host.call_plugin(host, 'transfer', 'get_expose_timings', args)
+    logging.debug('Got expose timings %r' % strrecord)
+    return record_to_dict(strrecord)
+
 def record_to_dict(xml):
-    result = {}
+    return records_to_dicts(xml)[0]
+
+def records_to_dicts(xml):
+    result = []
     doc = minidom.parseString(xml)
     try:
-        el = doc.getElementsByTagName('transfer_record')[0]
-        # Note that we have to convert this dictionary to non-unicode
-        # strings, because we're being casual elsewhere.  That's why we're
-        # not just returning dict(el.attributes.items()).
-        for k, v in el.attributes.items():
-            result[str(k)] = str(v)
+        for el in doc.getElementsByTagName('transfer_record'):
+            # Note that we have to convert this dictionary to non-unicode
+            # strings, because we're being casual elsewhere.  That's why we're
+            # not just returning dict(el.attributes.items()).
+            record = {}
+            for k, v in el.attributes.items():
+                record[str(k)] = str(v)
+            result.append(record)
     finally:
         doc.unlink()
     return result
@@ -0,0 +1,168 @@
+"""Tests of the protocol between the plugins and transferd, against fakes of
+the other side on a socket of their own.  These need no host."""
+
+import cStringIO
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import plugins
+import pluginlib
+import transferd
+
+
+REQUEST = '<methodCall><methodName>get_record</methodName></methodCall>'
+TIMEOUT = 0.2
+
+
+class FakeDaemon(object):
+    """Listens on a socket, and answers one call with the given status, then
+    passes on what comes back to the output."""
+
+    def __init__(self, path, status, output=''):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.status = status
+        self.output = output
+        self.received = None
+        self.thread = threading.Thread(target=self.answer)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def answer(self):
+        conn = self.server.accept()[0]
+        f = conn.makefile('rb')
+        try:
+            header = f.readline()
+            request = f.read(int(header.split()[1]))
+            conn.sendall(self.status + '\n')
+            if self.status == 'OK':
+                go = f.readline()
+                if go == 'GO\n':
+                    conn.sendall(self.output)
+            self.received = header + request
+        finally:
+            f.close()
+            conn.close()
+
+    def close(self):
+        self.thread.join(1)
+        self.server.close()
+
+
+class ForwardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_socket_path = transferd.SOCKET_PATH
+        self.old_timeout = transferd.REPLY_TIMEOUT_SECONDS
+        self.old_argv = sys.argv
+        transferd.SOCKET_PATH = os.path.join(self.dir, 'transferd.sock')
+        transferd.REPLY_TIMEOUT_SECONDS = TIMEOUT
+        sys.argv = ['transfer', REQUEST]
+
+    def tearDown(self):
+        transferd.SOCKET_PATH = self.old_socket_path
+        transferd.REPLY_TIMEOUT_SECONDS = self.old_timeout
+        sys.argv = self.old_argv
+        shutil.rmtree(self.dir)
+
+    def testReturnsWhenNoDaemonIsListening(self):
+        self.assertEqual(None, transferd.forward('transfer'))
+
+    def testReturnsWhenTheDaemonDoesNotAnswer(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(transferd.SOCKET_PATH)
+        server.listen(1)
+        try:
+            start = time.time()
+            self.assertEqual(None, transferd.forward('transfer'))
+            self.assert_(time.time() - start < TIMEOUT * 10)
+        finally:
+            server.close()
+
+    def testReturnsWhenTheDaemonIsBusy(self):
+        daemon = FakeDaemon(transferd.SOCKET_PATH, 'BUSY')
+        try:
+            self.assertEqual(None, transferd.forward('transfer'))
+        finally:
+            daemon.close()
+        self.assertEqual('transfer %d\n%s' % (len(REQUEST), REQUEST),
+                         daemon.received)
+
+    def testPrintsWhatTheCallPrinted(self):
+        daemon = FakeDaemon(transferd.SOCKET_PATH, 'OK', 'result')
+        old_stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            try:
+                self.assertRaises(SystemExit, transferd.forward, 'transfer')
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = old_stdout
+        finally:
+            daemon.close()
+        self.assertEqual('result', output)
+
+
+class HandleCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old_pluginlib = transferd.pluginlib
+        self.old_run_call = transferd.run_call
+        self.old_timeout = transferd.REPLY_TIMEOUT_SECONDS
+        transferd.pluginlib = pluginlib
+        transferd.run_call = self.run_call
+        transferd.REPLY_TIMEOUT_SECONDS = TIMEOUT
+        self.calls = []
+        self.plugin_sock, daemon_sock = \
+            socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Wrapped as accept wraps the sockets it returns, so that makefile
+        # gives a socket._fileobject, which raises socket.timeout.
+        self.daemon_sock = socket.socket(_sock=daemon_sock)
+
+    def tearDown(self):
+        transferd.pluginlib = self.old_pluginlib
+        transferd.run_call = self.old_run_call
+        transferd.REPLY_TIMEOUT_SECONDS = self.old_timeout
+        self.plugin_sock.close()
+        self.daemon_sock.close()
+
+    def run_call(self, plugin, module, sock, request):
+        self.calls.append((plugin, request))
+
+    def handle_call(self, sent, give_up=False):
+        self.plugin_sock.sendall(sent)
+        if give_up:
+            self.plugin_sock.shutdown(socket.SHUT_WR)
+        transferd.handle_call(
+            transferd.PluginSet({'transfer': object()}, {}), self.daemon_sock)
+        return self.plugin_sock.recv(100)
+
+    def testCallIsRunAfterGo(self):
+        status = self.handle_call('transfer %d\n%sGO\n' %
+                                  (len(REQUEST), REQUEST))
+        self.assertEqual('OK\n', status)
+        self.assertEqual([('transfer', REQUEST)], self.calls)
+
+    def testCallIsNotRunIfThePluginGivesUp(self):
+        status = self.handle_call('transfer %d\n%s' % (len(REQUEST), REQUEST),
+                                  True)
+        self.assertEqual('OK\n', status)
+        self.assertEqual([], self.calls)
+
+    def testPartOfARequestTimesOut(self):
+        self.assertRaises(socket.timeout, self.handle_call,
+                          'transfer %d\n%s' % (len(REQUEST), REQUEST[:10]))
+        self.assertEqual([], self.calls)
+
+    def testUnknownPluginIsTurnedDown(self):
+        status = self.handle_call('frob %d\n%sGO\n' % (len(REQUEST), REQUEST))
+        self.assertEqual('UNKNOWN\n', status)
+        self.assertEqual([], self.calls)
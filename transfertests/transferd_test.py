@@ -0,0 +1,49 @@
+import unittest
+
+import testsetup
+import transferclient
+
+
+def clean_up():
+    hostname = testsetup.HOST
+    testsetup.clean_host(hostname)
+
+class TransferdTest(unittest.TestCase):
+    """Calls to the transfer plugin made through transferd, which imports the
+    plugins in one process, must behave as they do when the plugin makes them
+    itself."""
+
+    def setUp(self):
+        testsetup.start_transferd(testsetup.HOST)
+        self.assert_(testsetup.transferd_is_running(testsetup.HOST))
+
+    def tearDown(self):
+        testsetup.stop_transferd(testsetup.HOST)
+
+    def testExposeVhdThroughDaemon(self):
+        # expose_vhd reads the bitmaps through vhd_bitmaps, which needs the
+        # standard copy module rather than the copy plugin.
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        record_handle = transferclient.expose(hostname, vdi_uuid=vdi, network_uuid=network,
+                                              transfer_mode='http', expose_vhd='true')
+        record = transferclient.get_record(hostname, vdi_uuid=vdi)
+        self.assertEqual('exposed', record['status'])
+        timings = transferclient.get_expose_timings(hostname, record_handle=record_handle)
+        self.assert_(float(timings['bitmaps']) >= 0)
+        self.assert_(testsetup.transferd_is_running(hostname))
+        clean_up()
+
+    def testGetBitmapsThroughDaemon(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        self.assert_(len(transferclient.get_vdi_bitmap(hostname, vdi)) > 0)
+        self.assert_(testsetup.transferd_is_running(hostname))
+        clean_up()
+
+    def testCallsFallBackWhenDaemonIsStopped(self):
+        hostname, network, vdi = testsetup.setup_host_and_network(templates=1, vdi_mb=10)
+        testsetup.stop_transferd(hostname)
+        self.failIf(testsetup.transferd_is_running(hostname))
+        transferclient.expose(hostname, vdi_uuid=vdi, network_uuid=network, transfer_mode='http')
+        record = transferclient.get_record(hostname, vdi_uuid=vdi)
+        self.assertEqual('exposed', record['status'])
+        clean_up()
@@ -0,0 +1,207 @@
+"""Tests of the streaming reading and rewriting of ova.xml in vm_metadata,
+against what make_new_vm_metadata made of it with minidom.  These need no
+host."""
+
+import cStringIO
+import tarfile
+import unittest
+from xml.dom import minidom
+
+import plugins
+import vm_metadata
+
+
+def value(v):
+    return '<value>%s</value>' % v
+
+def member(name, v):
+    return '<member><name>%s</name>%s</member>' % (name, value(v))
+
+def struct(*members):
+    return '<struct>%s</struct>' % ''.join(members)
+
+def export_object(cls, ref, snapshot, class_last=False):
+    members = [member('id', ref), member('snapshot', snapshot)]
+    if class_last:
+        members.append(member('class', cls))
+    else:
+        members.insert(0, member('class', cls))
+    return value(struct(*members))
+
+def vdi(uuid, location, virtual_size, is_a_snapshot, parent=None):
+    if parent is None:
+        sm_config = '<struct/>'
+    else:
+        sm_config = struct(member('vhd-parent', parent))
+    return struct(member('uuid', uuid),
+                  member('name_label', 'Disk of &quot;A&quot; &amp; B \xc3\xa9'),
+                  member('location', location),
+                  member('virtual_size', str(virtual_size)),
+                  member('is_a_snapshot', is_a_snapshot and '1' or '0'),
+                  member('sm_config', sm_config))
+
+def ova_xml(objects):
+    return value(struct(member('version', struct(member('hostname', 'h'))),
+                        member('objects', '<array><data>%s</data></array>' %
+                               ''.join(objects))))
+
+def tarball(ova):
+    """A VM export tarball holding the given ova.xml, as xapi writes it."""
+    out = cStringIO.StringIO()
+    tf = tarfile.open(mode='w:', fileobj=out)
+    ti = tarfile.TarInfo(name='ova.xml')
+    ti.size = len(ova)
+    tf.addfile(ti, cStringIO.StringIO(ova))
+    tf.close()
+    return out.getvalue()
+
+
+OVA_XML = ova_xml([
+    export_object('VM', 'OpaqueRef:vm',
+                  struct(member('name_label', 'VM &lt;1&gt;'),
+                         member('VBDs', '<array><data/></array>'))),
+    export_object('VDI', 'OpaqueRef:a', vdi('uuid-a', 'loc-a', 1024, False)),
+    # xapi may put the class after the snapshot.
+    export_object('VDI', 'OpaqueRef:b', vdi('uuid-b', 'loc-b', 1024, True, 'loc-a'),
+                  class_last=True),
+    export_object('VDI', 'OpaqueRef:c', vdi('uuid-c', 'loc-c', 1000, False, 'loc-b')),
+    export_object('SR', 'OpaqueRef:sr',
+                  struct(member('uuid', 'old-sr'), member('name_label', 'Local storage'))),
+    export_object('network', 'OpaqueRef:net',
+                  struct(member('uuid', 'net-uuid'), member('name_label', 'Pool-wide'),
+                         member('bridge', 'xenbr0'), member('MTU', '1500'))),
+])
+
+VDI_MAP = {'loc-a': 'new-a', 'loc-c': 'new-c'}
+SR_UUID = 'new-sr'
+
+
+def minidom_ova_xml(ova, vdi_map, sr_uuid):
+    """The new ova.xml as make_new_vm_metadata made it: parsed with minidom,
+    the VDI locations and SR uuid replaced, and written back with toxml."""
+    doc = minidom.parseString(ova)
+
+    def members(node):
+        result = {}
+        for m in node.childNodes:
+            result[m.childNodes[0].childNodes[0].wholeText] = m.childNodes[1]
+        return result
+
+    objects = members(doc.childNodes[0].childNodes[0])['objects']
+    for val in objects.childNodes[0].childNodes[0].childNodes:
+        obj = members(val.childNodes[0])
+        cls = obj['class'].childNodes[0].wholeText
+        snapshot = members(obj['snapshot'].childNodes[0])
+        if cls == 'VDI':
+            text = snapshot['location'].childNodes[0]
+            text.replaceWholeText(vdi_map.get(text.wholeText, 'OpaqueRef:NULL'))
+        elif cls == 'SR':
+            snapshot['uuid'].childNodes[0].replaceWholeText(sr_uuid)
+
+    result = doc.toxml().encode('UTF-8')
+    doc.unlink()
+    return result
+
+def minidom_tarball(ova, vdi_map, sr_uuid):
+    """The new tarball as make_new_vm_metadata made it."""
+    new_ova = minidom_ova_xml(ova, vdi_map, sr_uuid)
+    out = cStringIO.StringIO()
+    tf = tarfile.open(mode='w:', fileobj=out, bufsize=512)
+    ti = tarfile.TarInfo(name='ova.xml')
+    ti.size = len(new_ova)
+    tf.addfile(ti, cStringIO.StringIO(new_ova))
+    tf.close()
+    return out.getvalue()
+
+
+class ScanOvaXmlTest(unittest.TestCase):
+
+    def testFindsTheVdis(self):
+        ova = vm_metadata.scan_ova_xml(cStringIO.StringIO(tarball(OVA_XML)))
+        self.assertEqual({'loc-a': (None, 1024, False),
+                          'loc-b': ('loc-a', 1024, True),
+                          'loc-c': ('loc-b', 1000, False)},
+                         ova.vdis)
+
+    def testFindsTheNetworks(self):
+        ova = vm_metadata.scan_ova_xml(cStringIO.StringIO(tarball(OVA_XML)))
+        self.assertEqual(1, len(ova.networks))
+        network = ova.networks[0]
+        self.assertEqual('net-uuid', network['uuid'])
+        self.assertEqual('Pool-wide', network['name_label'])
+        self.assertEqual('xenbr0', network['bridge'])
+        self.assertEqual('1500', network['MTU'])
+        self.assertEqual({'created_on_import': 'true'}, network['other_config'])
+
+    def testInvalidXmlIsRejected(self):
+        self.assertRaises(vm_metadata.InvalidOVAXML, vm_metadata.scan_ova_xml,
+                          cStringIO.StringIO(tarball('<value><struct>')))
+
+    def testMissingLocationIsRejected(self):
+        ova = ova_xml([export_object('VDI', 'OpaqueRef:a',
+                                     struct(member('uuid', 'uuid-a')))])
+        self.assertRaises(vm_metadata.InvalidOVAXML, vm_metadata.scan_ova_xml,
+                          cStringIO.StringIO(tarball(ova)))
+
+
+class OvaXmlStreamTest(unittest.TestCase):
+
+    def rewrite(self, ova, vdi_map, sr_uuid):
+        out = cStringIO.StringIO()
+        stream = vm_metadata.OvaXmlStream(out, vdi_map, sr_uuid)
+        stream.run(cStringIO.StringIO(ova))
+        return out.getvalue()
+
+    def testRewriteMatchesMinidomByteForByte(self):
+        self.assertEqual(minidom_ova_xml(OVA_XML, VDI_MAP, SR_UUID),
+                         self.rewrite(OVA_XML, VDI_MAP, SR_UUID))
+
+    def testUnmappedVdisGetNullLocations(self):
+        new_ova = self.rewrite(OVA_XML, {}, SR_UUID)
+        self.assertEqual(minidom_ova_xml(OVA_XML, {}, SR_UUID), new_ova)
+        self.assertEqual(3, new_ova.count('<value>OpaqueRef:NULL</value>'))
+
+    def testRewriteCollectsTheVdisToo(self):
+        out = cStringIO.StringIO()
+        stream = vm_metadata.OvaXmlStream(out, VDI_MAP, SR_UUID)
+        stream.run(cStringIO.StringIO(OVA_XML))
+        self.assertEqual(['loc-a', 'loc-b', 'loc-c'], sorted(stream.vdis.keys()))
+
+
+class NewMetadataTarballTest(unittest.TestCase):
+
+    def new_tarball(self, vdi_map, sr_uuid):
+        new = vm_metadata.NewMetadataTarball(
+            cStringIO.StringIO(tarball(OVA_XML)), vdi_map, sr_uuid)
+        pieces = []
+        new.write_to(pieces.append)
+        return new, pieces
+
+    def testMatchesMinidomByteForByte(self):
+        new, pieces = self.new_tarball(VDI_MAP, SR_UUID)
+        self.assertEqual(minidom_tarball(OVA_XML, VDI_MAP, SR_UUID),
+                         ''.join(pieces))
+
+    def testSizeIsKnownBeforeWriting(self):
+        new, pieces = self.new_tarball(VDI_MAP, SR_UUID)
+        self.assertEqual(new.size, len(''.join(pieces)))
+        self.assertEqual(0, new.size % tarfile.RECORDSIZE)
+
+    def testWritesInChunks(self):
+        old_chunk_size = vm_metadata.WRITE_CHUNK_SIZE
+        vm_metadata.WRITE_CHUNK_SIZE = 100
+        try:
+            new, pieces = self.new_tarball(VDI_MAP, SR_UUID)
+        finally:
+            vm_metadata.WRITE_CHUNK_SIZE = old_chunk_size
+        self.assert_(len(pieces) > 1)
+        for piece in pieces[:-1]:
+            self.assert_(len(piece) >= 100)
+        self.assertEqual(minidom_tarball(OVA_XML, VDI_MAP, SR_UUID),
+                         ''.join(pieces))
+
+    def testResultCanBeScannedAgain(self):
+        new, pieces = self.new_tarball(VDI_MAP, SR_UUID)
+        ova = vm_metadata.scan_ova_xml(cStringIO.StringIO(''.join(pieces)))
+        self.assertEqual(['OpaqueRef:NULL', 'new-a', 'new-c'],
+                         sorted(ova.vdis.keys()))
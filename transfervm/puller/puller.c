@@ -30,7 +30,9 @@
 #include <string.h>
 #include <strings.h>
 #include <sys/socket.h>
+#include <sys/time.h>
 #include <sys/types.h>
+#include <sys/wait.h>
 #include <unistd.h>
 
 #include <openssl/err.h>
@@ -48,6 +50,31 @@ static BIO *bio_err = NULL;
 
 static char *bits_session_id = NULL;
 
+/* Seconds between progress reports. */
+#define PROGRESS_INTERVAL 5
+
+/*
+ * Progress is written to xenstore under this prefix, taken from
+ * $PULLER_PROGRESS_PREFIX, e.g. control/transfer-xvdb.  NULL if we're not
+ * reporting progress.
+ */
+static char *progress_prefix = NULL;
+static off64_t progress_bytes = 0;
+static off64_t progress_total = (off64_t)-1;
+static off64_t progress_last_bytes = 0;
+static struct timeval progress_last_time;
+
+/*
+ * If we were given a byte range, we fetch only bytes range_first to
+ * range_last (inclusive) of the source, and write them at the same offsets in
+ * the destination.  Several pullers can then fetch one VDI in parallel.
+ * range_total is the size of the whole source, from the Content-Range of the
+ * response.  All are -1 if we're fetching the whole thing.
+ */
+static off64_t range_first = (off64_t)-1;
+static off64_t range_last = (off64_t)-1;
+static off64_t range_total = (off64_t)-1;
+
 
 static SSL_CTX *make_ctx()
 {
@@ -217,9 +244,21 @@ static int make_request(char *path, char *username, char *password, char *buf,
     if (err != 0)
         return err;
     
-    *len = snprintf(buf, BIG_BUFSIZE,
-                    "GET %s HTTP/1.0\r\nAuthorization: Basic %.*s\r\n\r\n",
-                    path, auth_len, auth);
+    if (range_first == (off64_t)-1)
+    {
+        *len = snprintf(buf, BIG_BUFSIZE,
+                        "GET %s HTTP/1.0\r\n"
+                        "Authorization: Basic %.*s\r\n\r\n",
+                        path, auth_len, auth);
+    }
+    else
+    {
+        *len = snprintf(buf, BIG_BUFSIZE,
+                        "GET %s HTTP/1.0\r\n"
+                        "Authorization: Basic %.*s\r\n"
+                        "Range: bytes=%" PRId64 "-%" PRId64 "\r\n\r\n",
+                        path, auth_len, auth, range_first, range_last);
+    }
 
     free(auth);
 
@@ -256,6 +295,34 @@ static int send_request(char *path, char *username, char *password,
 #define STREAMING 3
 
 #define HTTP_200_OK "HTTP/1.0 200 OK\r\n"
+#define HTTP_206_PARTIAL "HTTP/1.0 206 Partial Content\r\n"
+
+
+/*
+ * Sets range_total from the Content-Range header in the given (terminated)
+ * response headers.  Returns an errno.  Sets err_buf.
+ */
+static int parse_content_range(char *headers)
+{
+    char *crange = strstr(headers, "Content-Range: bytes ");
+    if (crange == NULL)
+    {
+        crange = strstr(headers, "content-range: bytes ");
+    }
+    char *slash = crange == NULL ? NULL : strchr(crange, '/');
+    if (slash == NULL)
+    {
+        snprintf(err_buf, LITTLE_BUFSIZE,
+                 "<value><array><data>"
+                 "<value>PULLER_BAD_CONTENT_RANGE</value>"
+                 "</data></array></value>");
+        return EIO;
+    }
+
+    range_total = (off64_t)strtoll(slash + 1, NULL, 10);
+    fprintf(stderr, "Content-Range total is %" PRId64 ".\n", range_total);
+    return 0;
+}
 
 /*
  * Returns an errno.  Sets err_buf.
@@ -264,9 +331,14 @@ static int
 parse_response(char *buf, size_t len, int *state, off64_t *content_length,
                bool eof)
 {
+    /* A GET for a range must be answered with just that range. */
+    char *expected =
+        (content_length != NULL && range_first != (off64_t)-1) ?
+        HTTP_206_PARTIAL : HTTP_200_OK;
+
     if (*state == INITIAL)
     {
-        if (len < strlen(HTTP_200_OK))
+        if (len < strlen(expected))
         {
             if (eof)
             {
@@ -283,7 +355,7 @@ parse_response(char *buf, size_t len, int *state, off64_t *content_length,
             }
         }
 
-        if (0 == strncmp(buf, HTTP_200_OK, strlen(HTTP_200_OK)))
+        if (0 == strncmp(buf, expected, strlen(expected)))
         {
             *state = STATUS_OK;
         }
@@ -323,6 +395,12 @@ parse_response(char *buf, size_t len, int *state, off64_t *content_length,
                     fprintf(stderr, "Content-Length is %" PRIu64 ".\n",
                             *content_length);
                 }
+                if (range_first != (off64_t)-1)
+                {
+                    int err = parse_content_range(buf);
+                    if (err != 0)
+                        return err;
+                }
             }
             *state = STREAMING_NEXT;
         }
@@ -609,6 +687,66 @@ static int send_bits_fragment(char *dest_path,
 }
 
 
+/*
+ * Writes the bytes transferred so far, the total expected (if known) and the
+ * rate since the last report to xenstore, as <prefix>-bytes,
+ * <prefix>-total-bytes and <prefix>-rate, and then touches data/updated so
+ * that xapi picks them up.  Only does so every PROGRESS_INTERVAL seconds,
+ * unless force is set.  Failures are ignored: progress is only advisory.
+ */
+static void report_progress(bool force)
+{
+    if (progress_prefix == NULL)
+        return;
+
+    struct timeval now;
+    gettimeofday(&now, NULL);
+    double elapsed =
+        (now.tv_sec - progress_last_time.tv_sec) +
+        (now.tv_usec - progress_last_time.tv_usec) / 1000000.0;
+    if (!force && elapsed < PROGRESS_INTERVAL)
+        return;
+
+    uint64_t rate = elapsed > 0 ?
+        (uint64_t)((progress_bytes - progress_last_bytes) / elapsed) : 0;
+
+    char bytes_key[LITTLE_BUFSIZE], total_key[LITTLE_BUFSIZE],
+        rate_key[LITTLE_BUFSIZE];
+    char bytes_val[32], total_val[32], rate_val[32], updated_val[32];
+    snprintf(bytes_key, LITTLE_BUFSIZE, "%s-bytes", progress_prefix);
+    snprintf(total_key, LITTLE_BUFSIZE, "%s-total-bytes", progress_prefix);
+    snprintf(rate_key, LITTLE_BUFSIZE, "%s-rate", progress_prefix);
+    snprintf(bytes_val, sizeof(bytes_val), "%" PRId64, progress_bytes);
+    snprintf(total_val, sizeof(total_val), "%" PRId64, progress_total);
+    snprintf(rate_val, sizeof(rate_val), "%" PRIu64, rate);
+    snprintf(updated_val, sizeof(updated_val), "%ld", (long)now.tv_sec);
+
+    char *argv[] = { "xenstore-write",
+                     bytes_key, bytes_val,
+                     rate_key, rate_val,
+                     "data/updated", updated_val,
+                     /* Left off if we don't know the total. */
+                     total_key, total_val,
+                     NULL };
+    if (progress_total == (off64_t)-1)
+        argv[7] = NULL;
+
+    pid_t pid = fork();
+    if (pid == 0)
+    {
+        execvp(argv[0], argv);
+        _exit(127);
+    }
+    else if (pid > 0)
+    {
+        waitpid(pid, NULL, 0);
+    }
+
+    progress_last_time = now;
+    progress_last_bytes = progress_bytes;
+}
+
+
 /*
  * Returns an errno.  Sets err_buf.
  */
@@ -626,6 +764,8 @@ static int handle_read(char *buf, char *dest_path, bool eof,
     {
         *state = STREAMING;
         *buf_len = 0;
+        progress_total = *content_length;
+        report_progress(true);
         return 0;
     }
 
@@ -643,14 +783,26 @@ static int handle_read(char *buf, char *dest_path, bool eof,
 
     if (*state == STREAMING && *buf_len > 0)
     {
-        err = send_bits_fragment(dest_path, *dest_off, *content_length,
-                                 buf, *buf_len);
+        /* dest_off counts from the start of our range, if we have one. */
+        off64_t off = *dest_off;
+        off64_t total = *content_length;
+        if (range_first != (off64_t)-1)
+        {
+            off += range_first;
+            total = range_total;
+        }
+
+        err = send_bits_fragment(dest_path, off, total, buf, *buf_len);
         if (err != 0)
             return err;
 
         *dest_off += *buf_len;
         *buf_len = 0;
 
+        progress_bytes = *dest_off;
+        progress_total = *content_length;
+        report_progress(false);
+
         //fprintf(stderr, "dest_off is now %" PRId64 ".\n", *dest_off);
     }
 
@@ -847,7 +999,7 @@ done:
 
 static void usage()
 {
-    fprintf(stderr, "Usage: puller <src protocol> <src username> <src password> <src host> <src port> <src path> <src keyfile> <dest path>\n");
+    fprintf(stderr, "Usage: puller <src protocol> <src username> <src password> <src host> <src port> <src path> <src keyfile> <dest path> [<range first> <range last>]\n");
 }
 
 
@@ -855,7 +1007,14 @@ int main(int argc, char **argv)
 {
     assert(sizeof(off64_t) == 8);
 
-    if (argc != 9)
+    if (argc == 11)
+    {
+        range_first = (off64_t)strtoll(argv[9], NULL, 10);
+        range_last = (off64_t)strtoll(argv[10], NULL, 10);
+    }
+
+    if ((argc != 9 && argc != 11) ||
+        (argc == 11 && (range_first < 0 || range_last < range_first)))
     {
         usage();
         printf("<value><array><data>"
@@ -882,6 +1041,9 @@ int main(int argc, char **argv)
 
     err_buf[0] = '\0';
 
+    progress_prefix = getenv("PULLER_PROGRESS_PREFIX");
+    gettimeofday(&progress_last_time, NULL);
+
     err = create_bits_session(dest_path);
     if (err != 0)
         goto done;
@@ -949,6 +1111,9 @@ done:
 
     fprintf(stderr, "Transfer complete.\n");
 
+    if (err == 0)
+        report_progress(true);
+
     if (err == 0)
         printf("OK");
     else